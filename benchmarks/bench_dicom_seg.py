@@ -0,0 +1,180 @@
+# Benchmark of the DICOM-SEG encodings on a synthetic DICOM series and segmentation.
+# The output modes (one file per label, one multi-segment file) are written with the full encoding (a full-size
+# frame for every slice) and the compact one (frames cropped to the segmentation, no empty frames). For each one the
+# encoding time, the output size and the round-trip correctness (every segment read back with pydicom_seg and
+# resampled on the source series matches the input mask) are recorded in a JSON report.
+# Runs offline: no GPU, FreeSurfer or WMH-SynthSeg installation is needed.
+#
+# Example (from the root of the repository):
+#       python benchmarks/bench_dicom_seg.py --shape 256 256 176 --orientation axial --output bench_seg.json
+#
+import os
+import sys
+import json
+import logging
+import shutil
+import argparse
+import datetime
+import tempfile
+import warnings
+
+import numpy as np
+import pydicom
+import pydicom_seg
+import SimpleITK as sitk
+
+from psb.niiXdcm.dcm2nii import convert_dicom_files_to_image
+from psb.niiXdcm.nii2dcm import convert_nifti_seg_to_dicom_seg, build_multi_segment_metainfo, DicomSeries
+from psb.utils.image import Image, change_orientation, split_labels, number_labels
+
+from synthetic import ORIENTATIONS, make_dicom_series, make_label_volume
+from bench_pipeline import LABEL_MAP_PATH, TEMPLATE_DIR, MEMORY_MEASURES, measure, get_header, get_environment
+
+MODES = ['per-label', 'multi']
+ENCODINGS = ['full', 'compact']
+
+# Label of the small lesions added to the synthetic segmentation
+LESION_LABEL = 'WM-hypointensities'
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the DICOM-SEG encodings on a synthetic series')
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 256, 176], help='Columns, rows and number of slices of the series. Default=256 256 176')
+    parser.add_argument('--orientation', type=str, nargs='+', default=['axial'], choices=sorted(ORIENTATIONS), help='Acquisition planes benchmarked. Default=axial')
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES, help='Output modes benchmarked. Default: all')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each encoding. Default=3')
+    parser.add_argument('--output', type=str, default=None, help='Output JSON file. Default=benchmark_dicom_seg_<date>.json')
+    parser.add_argument('--tmp-dir', type=str, default=None, help='Folder for the synthetic series and the outputs. Default: system temporary folder')
+    return parser
+
+
+def make_segmentation(shape, label_dict, seed=0):
+    """
+    Synthetic brain-like segmentation: blocky regions of the labels inside a centered ellipsoid, and a few small
+    lesions, so that the labels only occupy part of the slices and of the field of view.
+    """
+    rng = np.random.default_rng(seed)
+    labels = [value for name, value in label_dict.items() if name != LESION_LABEL]
+    seg = make_label_volume(shape, labels, seed=seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing='ij')
+    seg[sum(g ** 2 for g in grid) > 0.6] = 0
+
+    if LESION_LABEL in label_dict:
+        size = np.maximum(np.array(shape) // 32, 1)
+        for _ in range(3):
+            start = [rng.integers(s // 3, 2 * s // 3) for s in shape]
+            seg[tuple(slice(b, b + n) for b, n in zip(start, size))] = label_dict[LESION_LABEL]
+    return seg
+
+
+def write_segmentation(mode, compact, dcm_series, dseg, label_dict, output_folder):
+    """
+    Write the DICOM-SEG of a segmentation as the pipeline does.
+
+    :return: list of the files written
+    """
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    files = []
+    if mode == 'multi':
+        seg, present = number_labels(dseg, label_dict)
+        metainfo = build_multi_segment_metainfo([os.path.join(TEMPLATE_DIR, f'{name}.json') for name, _, _ in present])
+        files.append(os.path.join(output_folder, 'multi.dcm'))
+        convert_nifti_seg_to_dicom_seg(dcm_series, seg, metainfo, compact=compact).save_as(files[-1])
+    else:
+        for label_name, intensity, mask in split_labels(dseg, label_dict):
+            if mask is not None:
+                files.append(os.path.join(output_folder, f'{intensity:02d}_{label_name}.dcm'))
+                template_path = os.path.join(TEMPLATE_DIR, f'{label_name}.json')
+                convert_nifti_seg_to_dicom_seg(dcm_series, mask, template_path, compact=compact).save_as(files[-1])
+    return files
+
+
+def check_round_trip(files, dcm_series, expected):
+    """
+    Read back the segments of DICOM-SEG files, resample them on the grid of the source series and compare them with
+    the expected masks.
+
+    :param expected: dict {segment description (label name): boolean array in SimpleITK order (z, y, x)}
+    :return: list of the label names whose mask differs (or is missing)
+    """
+    reference = dcm_series.copy_information(sitk.Image([int(s) for s in dcm_series.size], sitk.sitkUInt8))
+    reader = pydicom_seg.SegmentReader()
+    found = {}
+    for file in files:
+        result = reader.read(pydicom.dcmread(file))
+        for number in result.available_segments:
+            image = sitk.Resample(result.segment_image(number), reference, sitk.Transform(),
+                                  sitk.sitkNearestNeighbor, 0)
+            found[result.segment_infos[number].SegmentDescription] = sitk.GetArrayViewFromImage(image) > 0
+    return sorted(name for name, mask in expected.items()
+                  if name not in found or not np.array_equal(found[name], mask))
+
+
+def benchmark_series(dicom_folder, files, modes, repeat, label_dict, tmp_dir):
+    """
+    Benchmark the output modes and encodings on one DICOM series.
+
+    :return: dict {mode: {encoding: measures}}
+    """
+    anat = convert_dicom_files_to_image(files)
+    dseg = Image(make_segmentation(anat.data.shape, label_dict), hdr=get_header(anat, np.uint8))
+    dcm_series = DicomSeries(dicom_folder)
+
+    # Masks as given to SimpleITK by `convert_nifti_seg_to_dicom_seg` (orientation reversed)
+    seg_sitk = np.asarray(change_orientation(dseg, dseg.orientation[::-1]).data)
+    expected = {name: seg_sitk == value for name, value in label_dict.items() if np.any(seg_sitk == value)}
+
+    results = {}
+    for mode in modes:
+        results[mode] = {}
+        for encoding in ENCODINGS:
+            compact = encoding == 'compact'
+            output_folder = os.path.join(tmp_dir, 'seg', mode, encoding)
+            measures = measure(write_segmentation, lambda: (mode, compact, dcm_series, Image(dseg), label_dict,
+                                                             output_folder), repeat)
+            outputs = write_segmentation(mode, compact, dcm_series, Image(dseg), label_dict, output_folder)
+            errors = check_round_trip(outputs, dcm_series, expected)
+            measures.update(files=len(outputs), bytes=sum(os.path.getsize(f) for f in outputs),
+                            round_trip_ok=not errors, round_trip_errors=errors)
+            results[mode][encoding] = measures
+            print(f"  {mode} {encoding}: {measures['median_s']:.3f} s (median), {measures['files']} file(s), "
+                  f"{measures['bytes'] / 1024 ** 2:.2f} MB, round trip {'ok' if not errors else 'FAILED ' + str(errors)}")
+    return results
+
+
+def main():
+    args = get_parser().parse_args()
+    warnings.filterwarnings("ignore", category=UserWarning, module="pydicom.valuerep")
+    logging.basicConfig(level=logging.ERROR)
+    with open(LABEL_MAP_PATH, 'r') as f:
+        label_dict = json.load(f)
+
+    output = args.output or f"benchmark_dicom_seg_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': get_environment(),
+        'shape': args.shape,
+        'repeat': args.repeat,
+        'memory_measures': MEMORY_MEASURES,
+        'series': [],
+    }
+
+    tmp_dir = tempfile.mkdtemp(prefix='psb_benchmark_', dir=args.tmp_dir)
+    try:
+        for orientation in args.orientation:
+            print(f"Series {orientation} {tuple(args.shape)}")
+            dicom_folder = os.path.join(tmp_dir, orientation)
+            files = make_dicom_series(dicom_folder, shape=args.shape, orientation=orientation)
+            results = benchmark_series(dicom_folder, files, args.modes, args.repeat, label_dict, tmp_dir)
+            report['series'].append({'orientation': orientation, 'modes': results})
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved in {output}')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
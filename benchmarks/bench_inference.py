@@ -0,0 +1,98 @@
+# Benchmark of the optimized WMH-SynthSeg networks (psb.inference.optimize) against the reference network.
+# For each optimization, the inference time per volume is measured and the segmentations are compared with the
+# reference ones (Dice per label, fraction of changed voxels), so that any speedup comes with its drift.
+# Needs the WMH-SynthSeg weights and code (--wmh-dir); runs on CPU by default.
+#
+# Example (from the root of the repository):
+#       python benchmarks/bench_inference.py --wmh-dir /usr/local/WMHSynthSeg --images t1.nii.gz flair.nii.gz
+#
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import tempfile
+import shutil
+
+from psb.inference.wmh_synthseg import WMHSynthSeg, WMH_SYNTHSEG_DIR
+from psb.inference.optimize import OPTIMIZATIONS, check_accuracy, make_check_volume
+
+from bench_pipeline import get_environment
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the optimized WMH-SynthSeg networks against the reference one')
+    parser.add_argument('--wmh-dir', type=str, default=WMH_SYNTHSEG_DIR, help=f'WMH-SynthSeg installation folder. Default={WMH_SYNTHSEG_DIR}')
+    parser.add_argument('--images', type=str, nargs='+', default=None, help='NIfTI images segmented. Default: a synthetic volume')
+    parser.add_argument('--optimizations', type=str, nargs='+', default=[o for o in OPTIMIZATIONS if o != 'none'], choices=OPTIMIZATIONS[1:], help='Optimizations benchmarked. Default: all')
+    parser.add_argument('--device', type=str, default='cpu', help='Device of the inference. Default=cpu')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per volume. Default=3')
+    parser.add_argument('--output', type=str, default=None, help='Output JSON file. Default=benchmark_inference_<date>.json')
+    return parser
+
+
+def time_predict(model, network, volumes, repeat):
+    """
+    Median inference time per volume (seconds) of `network`.
+    """
+    import torch
+
+    times = []
+    with torch.no_grad():
+        model.predict(volumes[0], network=network)  # Warm-up (optimized graphs are specialized on the first runs)
+        for volume in volumes:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                model.predict(volume, network=network)
+                times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    import torch
+
+    args = get_parser().parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    output = args.output or f"benchmark_inference_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+
+    reference = WMHSynthSeg(wmh_dir=args.wmh_dir, device=args.device).load()
+    with torch.no_grad():
+        if args.images:
+            volumes = [reference.preprocess(path)[0][None, None, ...] for path in args.images]
+        else:
+            volumes = [torch.tensor(make_check_volume(), device=reference.device)[None, None, ...]]
+
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': dict(get_environment(), torch=torch.__version__, threads=torch.get_num_threads()),
+        'images': args.images or 'synthetic',
+        'device': reference.device,
+        'reference_s': time_predict(reference, reference.model, volumes, args.repeat),
+        'optimizations': {},
+    }
+    print(f"reference: {report['reference_s']:.3f} s per volume")
+
+    # Optimized networks are built in a temporary cache, so that the benchmark always measures the current code
+    cache_dir = tempfile.mkdtemp(prefix='psb_benchmark_models_')
+    try:
+        for optimization in args.optimizations:
+            model = WMHSynthSeg(wmh_dir=args.wmh_dir, device=args.device, optimization=optimization,
+                                cache_dir=cache_dir, check_paths=args.images, min_dice=0).load()
+            seconds = time_predict(model, model.network, volumes, args.repeat)
+            accuracy = check_accuracy(reference.model, model.network, volumes,
+                                      lambda net, vols: reference.predict(vols, network=net))
+            report['optimizations'][optimization] = dict(accuracy, seconds=seconds,
+                                                         speedup=report['reference_s'] / seconds)
+            print(f"{optimization}: {seconds:.3f} s per volume (x{report['reference_s'] / seconds:.2f}), "
+                  f"min Dice {accuracy['min_dice']:.4f}, changed voxels {accuracy['max_changed_voxels']:.2e}")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved in {output}')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
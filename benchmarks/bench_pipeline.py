@@ -0,0 +1,239 @@
+# Benchmark of the pipeline stages of psb.utils.image and psb.niiXdcm on synthetic DICOM series.
+# Each stage is timed separately and two peak memories are recorded: the Python and NumPy allocations (tracemalloc, in
+# a separate run) and the increase of the process RSS during the timed runs, which also covers the native allocations
+# (ITK/GDCM, zlib, ...) that tracemalloc does not see (Linux only). The results are saved as JSON to compare runs over
+# time.
+# Runs offline: no GPU, FreeSurfer or WMH-SynthSeg installation is needed.
+#
+# Example (from the root of the repository):
+#       python benchmarks/bench_pipeline.py --shape 256 256 176 --orientation axial sagittal --output bench.json
+#
+import os
+import sys
+import gc
+import json
+import logging
+import time
+import shutil
+import platform
+import argparse
+import datetime
+import tempfile
+import warnings
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+from psb.niiXdcm.dcm2nii import convert_dicom_to_nifti, convert_dicom_files_to_image
+from psb.niiXdcm.nii2dcm import convert_nifti_seg_to_dicom_seg, DicomSeries
+from psb.utils.image import Image, change_orientation, change_type, split_labels
+
+from synthetic import ORIENTATIONS, make_dicom_series, make_label_volume
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LABEL_MAP_PATH = os.path.join(REPO_DIR, 'src/psb/labels/WMH-SynthSeg/label-maps.json')
+TEMPLATE_DIR = os.path.join(REPO_DIR, 'src/psb/labels/WMH-SynthSeg/template')
+
+# Linux only: resettable peak RSS of the process
+PROC_STATUS_PATH = '/proc/self/status'
+PROC_CLEAR_REFS_PATH = '/proc/self/clear_refs'
+
+# Description of the memory measures, saved in the reports
+MEMORY_MEASURES = {
+    'peak_memory_mb': 'peak of the Python and NumPy allocations (tracemalloc), native allocations are not included',
+    'peak_rss_mb': 'peak increase of the process RSS over its value at the start of a run (all allocations, '
+                   'memory freed before the run and reused is not counted), null if the peak RSS cannot be reset',
+}
+
+STAGES = ['convert_dicom_to_nifti', 'convert_dicom_files_to_image', 'change_orientation', 'change_type',
+          'split_labels', 'convert_nifti_seg_to_dicom_seg']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic DICOM series')
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 256, 176], help='Columns, rows and number of slices of the series. Default=256 256 176')
+    parser.add_argument('--orientation', type=str, nargs='+', default=['axial', 'sagittal'], choices=sorted(ORIENTATIONS), help='Acquisition planes benchmarked. Default=axial sagittal')
+    parser.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES, help='Stages benchmarked. Default: all')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each stage. Default=3')
+    parser.add_argument('--output', type=str, default=None, help='Output JSON file. Default=benchmark_<date>.json')
+    parser.add_argument('--tmp-dir', type=str, default=None, help='Folder for the synthetic series. Default: system temporary folder')
+    return parser
+
+
+def measure(func, setup, repeat):
+    """
+    Time `func(*setup())` `repeat` times, measuring the peak RSS increase of each run, then measure its peak Python
+    and NumPy allocations in one more run (tracemalloc slows it down). `setup` is not timed.
+
+    :return: dict of the timings (seconds) and the peak memories (MB, see MEMORY_MEASURES)
+    """
+    times = []
+    rss_peaks = []
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        rss_start = reset_peak_rss()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+        if rss_start is not None:
+            rss_peaks.append(read_memory_status()['VmHWM'] - rss_start)
+
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'times_s': times,
+        'min_s': min(times),
+        'median_s': float(np.median(times)),
+        'peak_memory_mb': peak / 1024 ** 2,
+        'peak_rss_mb': max(rss_peaks) / 1024 ** 2 if rss_peaks else None,
+    }
+
+
+def read_memory_status():
+    """
+    Current and peak RSS of the process in bytes (VmRSS and VmHWM of /proc/self/status)
+    """
+    status = {}
+    with open(PROC_STATUS_PATH, 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                status[key] = int(value.split()[0]) * 1024
+    return status
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process to its current RSS.
+
+    :return: current RSS in bytes, or None if the peak RSS cannot be reset (not Linux, or not allowed)
+    """
+    try:
+        with open(PROC_CLEAR_REFS_PATH, 'w') as f:
+            f.write('5')
+        return read_memory_status()['VmRSS']
+    except (OSError, KeyError):
+        return None
+
+
+def benchmark_series(dicom_folder, files, stages, repeat, label_dict, tmp_dir):
+    """
+    Benchmark the stages on one DICOM series.
+
+    :return: dict {stage: measures}
+    """
+    anat = convert_dicom_files_to_image(files)
+    dseg = Image(make_label_volume(anat.data.shape, label_dict.values()), hdr=get_header(anat, np.uint8))
+    # Float image with integer values: worst case of change_type(..., 'minimize')
+    anat_float = Image(anat.data.astype(np.float32), hdr=get_header(anat, np.float32))
+    label_name, intensity = next(iter(label_dict.items()))
+    mask = Image((dseg.data == intensity).astype(np.uint8), hdr=dseg.hdr)
+    template_path = os.path.join(TEMPLATE_DIR, f'{label_name}.json')
+    nifti_folder = os.path.join(tmp_dir, 'nifti')
+
+    def to_nifti():
+        convert_dicom_to_nifti(dicom_folder, nifti_folder)
+
+    def reorient(im):
+        # The orientation is reversed, as done before writing a DICOM-SEG, and the result is materialized
+        im_dst = change_orientation(im, im.orientation[::-1])
+        np.ascontiguousarray(im_dst.data)
+
+    def split(im):
+        for _, _, label_mask in split_labels(im, label_dict):
+            if label_mask is not None:
+                np.count_nonzero(label_mask.data)
+
+    def reset_nifti_folder():
+        shutil.rmtree(nifti_folder, ignore_errors=True)
+        os.makedirs(nifti_folder)
+        return ()
+
+    dcm_series = DicomSeries(dicom_folder) if 'convert_nifti_seg_to_dicom_seg' in stages else None
+    benchmarks = {
+        'convert_dicom_to_nifti': (to_nifti, reset_nifti_folder),
+        'convert_dicom_files_to_image': (convert_dicom_files_to_image, lambda: (files,)),
+        'change_orientation': (reorient, lambda: (Image(anat),)),
+        'change_type': (change_type, lambda: (anat_float, 'minimize')),
+        'split_labels': (split, lambda: (dseg,)),
+        # The source series is read once per series by the pipeline, only the writing of one label is timed
+        'convert_nifti_seg_to_dicom_seg': (convert_nifti_seg_to_dicom_seg, lambda: (dcm_series, Image(mask), template_path)),
+    }
+
+    results = {}
+    for stage in stages:
+        func, setup = benchmarks[stage]
+        try:
+            results[stage] = measure(func, setup, repeat)
+        except Exception as e:
+            # A failing stage is recorded and does not stop the other ones
+            results[stage] = {'error': f'{type(e).__name__}: {e}'}
+            print(f"  {stage}: failed ({results[stage]['error']})")
+            continue
+        rss = results[stage]['peak_rss_mb']
+        print(f"  {stage}: {results[stage]['median_s']:.3f} s (median), {results[stage]['peak_memory_mb']:.1f} MB "
+              f"(peak Python/NumPy), {'n/a' if rss is None else f'{rss:.1f} MB'} (peak RSS increase)")
+    return results
+
+
+def get_header(im, dtype):
+    hdr = im.hdr.copy()
+    hdr.set_data_dtype(dtype)
+    return hdr
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def main():
+    args = get_parser().parse_args()
+    warnings.filterwarnings("ignore", category=UserWarning, module="pydicom.valuerep")
+    logging.basicConfig(level=logging.ERROR)
+    with open(LABEL_MAP_PATH, 'r') as f:
+        label_dict = json.load(f)
+
+    output = args.output or f"benchmark_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': get_environment(),
+        'shape': args.shape,
+        'repeat': args.repeat,
+        'memory_measures': MEMORY_MEASURES,
+        'series': [],
+    }
+
+    tmp_dir = tempfile.mkdtemp(prefix='psb_benchmark_', dir=args.tmp_dir)
+    try:
+        for orientation in args.orientation:
+            print(f"Series {orientation} {tuple(args.shape)}")
+            dicom_folder = os.path.join(tmp_dir, orientation)
+            files = make_dicom_series(dicom_folder, shape=args.shape, orientation=orientation)
+            results = benchmark_series(dicom_folder, files, args.stages, args.repeat, label_dict, tmp_dir)
+            report['series'].append({'orientation': orientation, 'stages': results})
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved in {output}')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
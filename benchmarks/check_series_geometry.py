@@ -0,0 +1,79 @@
+# Check of the geometry computed by psb.niiXdcm.nii2dcm.DicomSeries from the DICOM headers against the one of
+# SimpleITK's series reader, on synthetic series with uniform and non-uniform slice sampling (irregular spacing and
+# a missing slice) in every acquisition plane. The DICOM-SEG grid must match the one of the source series read by ITK.
+# Runs offline: no GPU, FreeSurfer or WMH-SynthSeg installation is needed.
+#
+# Example (from the root of the repository):
+#       python benchmarks/check_series_geometry.py
+#
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+from psb.niiXdcm.nii2dcm import DicomSeries
+
+from synthetic import ORIENTATIONS, make_dicom_series
+
+# Slice positions along the slice axis (mm) of the checked series
+SAMPLINGS = {
+    'uniform': [1.2 * k for k in range(8)],
+    'non-uniform': [0.0, 1.0, 2.5, 3.1, 4.2, 6.0, 6.5, 9.0],
+    'missing-slice': [0.0, 1.0, 2.0, 3.0, 5.0, 6.0, 7.0, 8.0],
+}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Check the DICOM series geometry against SimpleITK')
+    parser.add_argument('--shape', type=int, nargs=2, default=[16, 12], help='Columns and rows of the series. Default=16 12')
+    parser.add_argument('--tmp-dir', type=str, default=None, help='Folder for the synthetic series. Default: system temporary folder')
+    return parser
+
+
+def check_series(dicom_folder):
+    """
+    Compare the geometry of `DicomSeries` with the one of `sitk.ImageSeriesReader`.
+
+    :return: list of the differing attributes
+    """
+    series = DicomSeries(dicom_folder)
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(series.files)
+    image = reader.Execute()
+    errors = []
+    for name, expected, value in [('size', image.GetSize(), series.size),
+                                  ('origin', image.GetOrigin(), series.origin),
+                                  ('spacing', image.GetSpacing(), series.spacing),
+                                  ('direction', image.GetDirection(), series.direction)]:
+        if len(expected) != len(value) or not np.allclose(expected, value, atol=1e-4):
+            errors.append(f'{name}: sitk {tuple(expected)}, psb {tuple(value)}')
+    return errors
+
+
+def main():
+    args = get_parser().parse_args()
+    sitk.ProcessObject.SetGlobalWarningDisplay(False)  # Non-uniform sampling warnings of the series reader
+    tmp_dir = tempfile.mkdtemp(prefix='psb_check_', dir=args.tmp_dir)
+    failures = 0
+    try:
+        for orientation in sorted(ORIENTATIONS):
+            for sampling, offsets in SAMPLINGS.items():
+                dicom_folder = os.path.join(tmp_dir, f'{orientation}_{sampling}')
+                make_dicom_series(dicom_folder, shape=args.shape + [len(offsets)], orientation=orientation,
+                                  slice_offsets=offsets)
+                errors = check_series(dicom_folder)
+                failures += bool(errors)
+                print(f"{orientation} {sampling}: {'ok' if not errors else 'FAILED'}")
+                for error in errors:
+                    print(f'  {error}')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# Parity check of the in-process WMH-SynthSeg (psb.inference.wmh_synthseg) against the original script of the
+# release (`python3 inference.py --i <image> --o <segmentation>`). Both segment the same images on CPU and the outputs
+# are compared: shape, affine, Dice per label and fraction of voxels with a different label. The comparison is saved
+# in a JSON report, to be kept with the release it was run on.
+# By default two synthetic volumes are checked: a sub-millimetric one (0.8 mm isotropic) and an anisotropic one
+# (0.9 x 0.9 x 3 mm), which exercise the resampling to 1 mm.
+# Needs the WMH-SynthSeg weights and code (--wmh-dir).
+#
+# Example (from the root of the repository):
+#       python benchmarks/check_wmh_parity.py --wmh-dir /usr/local/WMHSynthSeg --output parity.json
+#
+import os
+import sys
+import json
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+from psb.inference.wmh_synthseg import WMHSynthSeg, WMH_SYNTHSEG_DIR
+from psb.inference.optimize import dice_per_label, make_check_volume
+
+from bench_pipeline import get_environment
+
+# Synthetic volumes checked by default: name -> voxel size (mm)
+SYNTHETIC_VOLUMES = {
+    'sub-mm': (0.8, 0.8, 0.8),
+    'anisotropic': (0.9, 0.9, 3.0),
+}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Check the in-process WMH-SynthSeg against the original inference.py')
+    parser.add_argument('--wmh-dir', type=str, default=WMH_SYNTHSEG_DIR, help=f'WMH-SynthSeg installation folder. Default={WMH_SYNTHSEG_DIR}')
+    parser.add_argument('--images', type=str, nargs='+', default=None, help='NIfTI images segmented. Default: synthetic sub-mm and anisotropic volumes')
+    parser.add_argument('--fov', type=float, nargs=3, default=[160, 192, 160], help='Field of view of the synthetic volumes (mm). Default=160 192 160')
+    parser.add_argument('--python', type=str, default='python3', help='Python interpreter running inference.py. Default=python3')
+    parser.add_argument('--output', type=str, default=None, help='Output JSON file. Default=wmh_parity_<date>.json')
+    return parser
+
+
+def make_volume(path, zooms, fov):
+    """
+    Write a synthetic head-like volume with the voxel size `zooms` (RAS axes).
+    """
+    shape = tuple(int(round(f / z)) for f, z in zip(fov, zooms))
+    affine = np.diag(list(zooms) + [1.0])
+    affine[:3, 3] = -0.5 * np.array(fov)
+    nib.save(nib.Nifti1Image((1000 * make_check_volume(shape)).astype(np.int16), affine), path)
+    return path
+
+
+def compare(path_ref, path):
+    """
+    Compare the segmentation of the original script with the one of the in-process version.
+    """
+    im_ref, im = nib.load(path_ref), nib.load(path)
+    result = {'shape_ref': list(im_ref.shape), 'shape': list(im.shape),
+              'affine_equal': bool(np.allclose(im_ref.affine, im.affine, atol=1e-4))}
+    if im_ref.shape != im.shape:
+        result.update(identical=False)
+        return result
+    seg_ref = np.asanyarray(im_ref.dataobj).astype(np.int32)
+    seg = np.asanyarray(im.dataobj).astype(np.int32)
+    dice = dice_per_label(seg_ref, seg)
+    result.update(dice={str(label): value for label, value in sorted(dice.items())},
+                  min_dice=min(dice.values()) if dice else 1.0,
+                  changed_voxels=float(np.mean(seg_ref != seg)),
+                  identical=bool(result['affine_equal'] and np.array_equal(seg_ref, seg)))
+    return result
+
+
+def main():
+    args = get_parser().parse_args()
+    output = args.output or f"wmh_parity_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': get_environment(),
+        'wmh_dir': args.wmh_dir,
+        'volumes': {},
+    }
+
+    tmp_dir = tempfile.mkdtemp(prefix='psb_parity_')
+    try:
+        if args.images:
+            images = {os.path.basename(path): path for path in args.images}
+        else:
+            images = {name: make_volume(os.path.join(tmp_dir, f'{name}.nii.gz'), zooms, args.fov)
+                      for name, zooms in SYNTHETIC_VOLUMES.items()}
+
+        model = WMHSynthSeg(wmh_dir=args.wmh_dir, device='cpu').load()
+        for idx, (name, path) in enumerate(images.items()):
+            path_ref = os.path.join(tmp_dir, f'{idx}_original.nii.gz')
+            path_port = os.path.join(tmp_dir, f'{idx}_psb.nii.gz')
+            subprocess.run([args.python, os.path.join(args.wmh_dir, 'inference.py'), '--i', path, '--o', path_ref,
+                            '--device', 'cpu'], check=True)
+            model.segment(path, path_port)
+            result = compare(path_ref, path_port)
+            result['zooms'] = [float(z) for z in nib.load(path).header.get_zooms()[:3]]
+            report['volumes'][name] = result
+            print(f"{name} {tuple(result['zooms'])}: {'identical' if result['identical'] else 'DIFFERENT'}"
+                  + (f", min Dice {result['min_dice']:.4f}, changed voxels {result['changed_voxels']:.2e}"
+                     if 'min_dice' in result else f", shapes {result['shape_ref']} and {result['shape']}"))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    report['identical'] = all(result['identical'] for result in report['volumes'].values())
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved in {output}')
+    return 0 if report['identical'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+# Synthetic DICOM series for the benchmarks: no scanner data, GPU or FreeSurfer installation is needed.
+#
+# Example:
+#       python benchmarks/synthetic.py --output /tmp/synthetic_dicom --shape 256 256 176 --orientation sagittal
+#
+import os
+import argparse
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+# ImageOrientationPatient (row direction, column direction) of the supported acquisition planes
+ORIENTATIONS = {
+    'axial': (1, 0, 0, 0, 1, 0),
+    'coronal': (1, 0, 0, 0, 0, -1),
+    'sagittal': (0, 1, 0, 0, 0, -1),
+    'oblique': (0.9848078, 0.1736482, 0, -0.1736482, 0.9848078, 0),
+}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Generate a synthetic DICOM series')
+    parser.add_argument('--output', type=str, required=True, help='Output folder of the series')
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 256, 176], help='Columns, rows and number of slices. Default=256 256 176')
+    parser.add_argument('--orientation', type=str, default='axial', choices=sorted(ORIENTATIONS), help='Acquisition plane. Default=axial')
+    parser.add_argument('--spacing', type=float, nargs=3, default=[1.0, 1.0, 1.0], help='Column, row and slice spacing (mm). Default=1 1 1')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random intensities. Default=0')
+    return parser
+
+
+def make_dicom_series(output_folder, shape=(256, 256, 176), orientation='axial', spacing=(1.0, 1.0, 1.0), seed=0,
+                      slice_offsets=None):
+    """
+    Write a single-frame MR series (16 bits, one file per slice) with random intensities.
+
+    :param output_folder: folder receiving the `.dcm` files (created if needed)
+    :param shape: number of columns, rows and slices
+    :param orientation: acquisition plane, key of ORIENTATIONS
+    :param spacing: column, row and slice spacing in mm
+    :param seed: seed of the random intensities
+    :param slice_offsets: position of each slice along the slice axis in mm, e.g. for a series with non-uniform\
+                          sampling (default: uniform, `k * spacing[2]`)
+    :return: list of the written files
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    n_columns, n_rows, n_slices = shape
+    iop = ORIENTATIONS[orientation]
+    row_dir, col_dir = np.array(iop[:3], dtype=float), np.array(iop[3:], dtype=float)
+    slice_dir = np.cross(row_dir, col_dir)
+    origin = -0.5 * (n_columns * spacing[0] * row_dir + n_rows * spacing[1] * col_dir + n_slices * spacing[2] * slice_dir)
+
+    if slice_offsets is None:
+        slice_offsets = [k * spacing[2] for k in range(n_slices)]
+    elif len(slice_offsets) != n_slices:
+        raise ValueError(f"Expected {n_slices} slice offsets, got {len(slice_offsets)}")
+
+    rng = np.random.default_rng(seed)
+    study_uid, series_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    files = []
+    for k in range(n_slices):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = MRImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = MRImageStorage
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.Modality = 'MR'
+        ds.Manufacturer = 'Synthetic'
+        ds.PatientName = 'Synthetic'
+        ds.PatientID = 'synthetic'
+        ds.PatientBirthDate = ''
+        ds.PatientSex = ''
+        ds.ReferringPhysicianName = ''
+        ds.AccessionNumber = ''
+        ds.StudyID = '1'
+        ds.StudyDate = '20240101'
+        ds.StudyTime = '000000'
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.FrameOfReferenceUID = frame_uid
+        ds.SeriesNumber = 1
+        ds.SeriesDescription = f'synthetic_{orientation}'
+        ds.InstanceNumber = k + 1
+        ds.ImageOrientationPatient = [float(x) for x in iop]
+        ds.ImagePositionPatient = (origin + slice_offsets[k] * slice_dir).tolist()
+        ds.PixelSpacing = [spacing[1], spacing[0]]
+        ds.SliceThickness = spacing[2]
+        ds.Rows = n_rows
+        ds.Columns = n_columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = rng.integers(0, 4096, size=(n_rows, n_columns), dtype=np.uint16).tobytes()
+
+        file_path = os.path.join(output_folder, f'IM{k:05d}.dcm')
+        ds.save_as(file_path, write_like_original=False)
+        files.append(file_path)
+    return files
+
+
+def make_label_volume(shape, labels, seed=0):
+    """
+    Discrete segmentation with blocky regions of every label (and background), to exercise the label split and
+    the DICOM-SEG writing.
+
+    :param shape: shape of the volume
+    :param labels: list of label values
+    :param seed: seed of the label layout
+    :return: uint8 array
+    """
+    rng = np.random.default_rng(seed)
+    values = np.array([0] + sorted(labels), dtype=np.uint8)
+    blocks = rng.integers(0, len(values), size=tuple(max(1, s // 16) for s in shape))
+    idx = [np.minimum(np.arange(s) * b // s, b - 1) for s, b in zip(shape, blocks.shape)]
+    return values[blocks[np.ix_(*idx)]]
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    files = make_dicom_series(args.output, shape=args.shape, orientation=args.orientation, spacing=args.spacing, seed=args.seed)
+    print(f'{len(files)} files written in {args.output}')
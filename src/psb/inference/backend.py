@@ -0,0 +1,112 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEVICES = ('auto', 'cpu', 'cuda')
+
+
+def resolve_device(device):
+    """
+    Torch device to use: 'auto' is 'cuda' when a GPU is available, 'cpu' otherwise.
+    """
+    if device not in DEVICES and not device.startswith('cuda:'):
+        raise ValueError(f"Unknown device {device}, expected one of {', '.join(DEVICES)}")
+    if device == 'auto':
+        import torch
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    return device
+
+
+def get_available_cores():
+    """
+    CPU cores the current process is allowed to run on.
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # No affinity support (e.g. macOS)
+        return list(range(os.cpu_count() or 1))
+
+
+class InferenceBackend(object):
+    """
+    Threading settings of one inference process, applied by `setup` in that process before the model is loaded (the
+    device is chosen by the model, see `resolve_device`).
+
+    The object only holds plain values, so it can be sent to the inference process.
+    """
+
+    def __init__(self, threads=None, interop_threads=None, cores=None):
+        """
+        :param threads: number of intra-op threads of torch (None: torch default)
+        :param interop_threads: number of inter-op threads of torch (None: torch default)
+        :param cores: list of CPU cores the process is pinned to (None: no pinning)
+        """
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.cores = cores
+
+    def setup(self):
+        """
+        Pin the current process and configure the torch threads.
+        """
+        import torch
+
+        if self.cores:
+            try:
+                os.sched_setaffinity(0, self.cores)
+            except (AttributeError, OSError) as e:
+                logger.warning(f"Unable to pin the inference process to the cores {self.cores}: {e}")
+        if self.threads is not None:
+            torch.set_num_threads(self.threads)
+        if self.interop_threads is not None:
+            # Only possible before any inter-op parallel work, i.e. in a fresh process
+            torch.set_num_interop_threads(self.interop_threads)
+
+    def get_info(self):
+        """
+        Settings in effect in the current process, e.g. to be saved with the inference profile.
+        """
+        import torch
+
+        return {'threads': torch.get_num_threads(), 'interop_threads': torch.get_num_interop_threads(),
+                'cores': self.cores}
+
+    def __repr__(self):
+        return f"InferenceBackend(threads={self.threads}, interop_threads={self.interop_threads}, cores={self.cores})"
+
+
+def plan_backends(pool_size, device='auto', threads=None, interop_threads=None, reserved_cores=0, pin=False):
+    """
+    Settings of the `pool_size` inference processes of a node.
+
+    On CPU, the cores not reserved for the other stages (DICOM conversion and export) are split between the inference
+    processes, so that the processes running at the same time do not compete for the same cores. Each process gets
+    as many intra-op threads as cores (unless `threads` is set), and is pinned to its cores if `pin` is True.
+
+    :param pool_size: number of inference processes
+    :param device: device of the model: 'cpu', 'cuda' or 'auto' (the threads are only set by default on CPU)
+    :param threads: intra-op threads per process (None: cores per process on CPU, torch default on GPU)
+    :param interop_threads: inter-op threads per process (None: torch default)
+    :param reserved_cores: number of cores left to the other stages
+    :param pin: whether to pin each process to its cores
+    :return: list of InferenceBackend, one per process
+    """
+    cores = get_available_cores()
+    # At least one core per inference process
+    reserved_cores = max(0, min(reserved_cores, len(cores) - pool_size))
+    inference_cores = cores[reserved_cores:]
+    per_process = max(1, len(inference_cores) // pool_size)
+
+    backends = []
+    for idx in range(pool_size):
+        process_cores = inference_cores[idx * per_process:(idx + 1) * per_process] or inference_cores
+        if threads is None and not device.startswith('cuda'):
+            process_threads = len(process_cores)
+        else:
+            # On GPU the CPU threads matter less: torch default unless set
+            process_threads = threads
+        backends.append(InferenceBackend(threads=process_threads, interop_threads=interop_threads,
+                                         cores=process_cores if pin else None))
+    return backends
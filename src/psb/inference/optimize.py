@@ -0,0 +1,209 @@
+import os
+import json
+import logging
+import warnings
+
+import numpy as np
+
+from psb.utils.manifest import fingerprint_files
+
+logger = logging.getLogger(__name__)
+
+# Optimized versions of the network:
+# - torchscript: traced, frozen and optimized for inference (same float32 computations, fused and prepacked)
+# - bfloat16: same as torchscript, with the weights and activations in bfloat16 (faster on CPUs with bfloat16
+#   instructions, e.g. AVX512-BF16/AMX, at the cost of a small drift)
+OPTIMIZATIONS = ('none', 'torchscript', 'bfloat16')
+
+# Default folder of the optimized models
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'psb', 'models')
+
+# Shape of the example used to trace the network (a multiple of 32, as the padded volumes)
+TRACE_SHAPE = (1, 1, 64, 64, 64)
+
+
+def get_optimized_model_path(model_path, optimization, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Path of the cached optimized model, unique to the weights file (path, size, modification time), the
+    optimization and the torch version.
+    """
+    import torch
+
+    key = fingerprint_files([model_path], extra=(optimization, torch.__version__))[:16]
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_dir, f'{name}_{optimization}_{key}.pt')
+
+
+def build_optimized_model(network, optimization, device='cpu'):
+    """
+    Trace, freeze and optimize a network for inference.
+
+    :param network: torch module in eval mode
+    :param optimization: one of OPTIMIZATIONS (except 'none')
+    :return: torch.jit.ScriptModule taking and returning float32 tensors
+    """
+    return _optimize_for_inference(_build_frozen_model(network, optimization, device=device))
+
+
+def _build_frozen_model(network, optimization, device='cpu'):
+    """
+    Traced and frozen network, the form saved in the cache: the graph optimized for inference cannot be serialized,
+    so `_optimize_for_inference` is applied once loaded.
+    """
+    import torch
+
+    if optimization not in OPTIMIZATIONS or optimization == 'none':
+        raise ValueError(f"Unknown optimization {optimization}, expected one of {', '.join(OPTIMIZATIONS[1:])}")
+    dtype = torch.bfloat16 if optimization == 'bfloat16' else torch.float32
+    with torch.no_grad(), warnings.catch_warnings():
+        # Recent torch versions deprecate TorchScript in favour of torch.compile/torch.export (still supported)
+        warnings.simplefilter('ignore', FutureWarning)
+        example = torch.rand(*TRACE_SHAPE, device=device)
+        traced = torch.jit.trace(_cast_network(network, dtype), example)
+        return torch.jit.freeze(traced)
+
+
+def _optimize_for_inference(frozen):
+    import torch
+
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        return torch.jit.optimize_for_inference(frozen)
+
+
+def load_optimized_model(network, model_path, optimization, get_check_volumes, predict, check_paths=None,
+                         cache_dir=DEFAULT_CACHE_DIR, device='cpu'):
+    """
+    Load the optimized network from the cache, or build it, check its accuracy and save it in the cache.
+
+    The accuracy report (Dice per label against `network` on the check volumes) is saved next to the model with a
+    fingerprint of the check images, and returned, so the drift of a cached model is known without running the check
+    again. The check is run again on the cached model if it was done on other images.
+
+    :param network: reference network
+    :param model_path: weights of the reference network (part of the cache key)
+    :param optimization: one of OPTIMIZATIONS (except 'none')
+    :param get_check_volumes: function returning the list of preprocessed volumes (torch tensors of shape\
+                              (1, 1, x, y, z)) used for the check, only called when the check is run
+    :param predict: function `predict(network, volumes)` returning the discrete segmentation of the volumes
+    :param check_paths: images of the check volumes (None: synthetic volume), part of the report fingerprint
+    :param cache_dir: folder of the optimized models
+    :return: (optimized network, accuracy report)
+    """
+    import torch
+
+    path = get_optimized_model_path(model_path, optimization, cache_dir=cache_dir)
+    report_path = f'{os.path.splitext(path)[0]}.json'
+    check_fingerprint = fingerprint_files(check_paths) if check_paths else 'synthetic'
+    optimized = None
+    if os.path.isfile(path) and os.path.isfile(report_path):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', FutureWarning)
+                optimized = _optimize_for_inference(torch.jit.load(path, map_location=device))
+            with open(report_path, 'r') as f:
+                report = json.load(f)
+            logger.info(f"Loaded the optimized model {path}")
+            if report.get('check_fingerprint') == check_fingerprint:
+                return optimized, report
+            logger.info(f"The accuracy of {path} was checked on other images, it is checked again")
+        except (OSError, RuntimeError, ValueError) as e:
+            logger.warning(f"Unable to load the optimized model {path}, it is built again: {e}")
+            optimized = None
+
+    if optimized is None:
+        logger.info(f"Building the {optimization} model of {model_path}")
+        frozen = _build_frozen_model(network, optimization, device=device)
+
+        # Saved atomically, a model being written by another process is never loaded
+        os.makedirs(cache_dir, exist_ok=True)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            torch.jit.save(frozen, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        optimized = _optimize_for_inference(frozen)
+
+    report = check_accuracy(network, optimized, get_check_volumes(), predict)
+    report['optimization'] = optimization
+    report['model_path'] = model_path
+    report['check_paths'] = list(check_paths) if check_paths else None
+    report['check_fingerprint'] = check_fingerprint
+    with open(f'{report_path}.tmp', 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(f'{report_path}.tmp', report_path)
+    return optimized, report
+
+
+def check_accuracy(reference, optimized, volumes, predict):
+    """
+    Compare the segmentations of an optimized network with the reference one.
+
+    :param volumes: list of preprocessed volumes (torch tensors of shape (1, 1, x, y, z))
+    :param predict: function `predict(network, volumes)` returning the discrete segmentation of the volumes
+    :return: dict with the Dice per label (worst over the volumes), the minimum Dice and the fraction of voxels\
+             with a different label
+    """
+    import torch
+
+    dice = {}
+    changed = []
+    with torch.no_grad():
+        for volume in volumes:
+            seg_ref = predict(reference, volume).cpu().numpy()
+            seg = predict(optimized, volume).cpu().numpy()
+            changed.append(float(np.mean(seg_ref != seg)))
+            for label, value in dice_per_label(seg_ref, seg).items():
+                dice[label] = min(dice.get(label, 1.0), value)
+    return {'dice': {str(label): value for label, value in sorted(dice.items())},
+            'min_dice': min(dice.values()) if dice else 1.0,
+            'max_changed_voxels': max(changed) if changed else 0.0}
+
+
+def dice_per_label(seg_ref, seg):
+    """
+    Dice score of each label present in either segmentation.
+
+    :return: dict {label: dice}
+    """
+    labels = np.union1d(np.unique(seg_ref), np.unique(seg))
+    dice = {}
+    for label in labels:
+        mask_ref = seg_ref == label
+        mask = seg == label
+        dice[int(label)] = 2.0 * np.count_nonzero(mask_ref & mask) / (np.count_nonzero(mask_ref) + np.count_nonzero(mask))
+    return dice
+
+
+def make_check_volume(shape=(96, 128, 96), seed=0):
+    """
+    Synthetic head-like volume (nested ellipsoids of different intensities and noise) used to check the optimized
+    network when no real image is given. Its shape differs from the tracing example on purpose.
+
+    :return: float32 array normalized to [0, 1]
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, s, dtype=np.float32) for s in shape], indexing='ij')
+    radius = np.sqrt(sum(g ** 2 for g in grid))
+    volume = np.select([radius < 0.4, radius < 0.7, radius < 0.85], [0.8, 0.5, 0.3], 0.0).astype(np.float32)
+    volume += 0.05 * rng.standard_normal(shape).astype(np.float32)
+    volume -= volume.min()
+    return volume / volume.max()
+
+
+def _cast_network(network, dtype):
+    """
+    Copy of a network running in another dtype, with float32 inputs and outputs (torch is imported lazily, so the
+    module class is defined here).
+    """
+    import copy
+    import torch
+
+    class CastNetwork(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.network = copy.deepcopy(network).to(dtype)
+
+        def forward(self, x):
+            return self.network(x.to(dtype)).float()
+
+    return CastNetwork().eval()
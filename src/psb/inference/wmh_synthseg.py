@@ -0,0 +1,243 @@
+import os
+import sys
+import glob
+import logging
+import numpy as np
+import nibabel as nib
+
+from psb.inference.backend import resolve_device
+from psb.inference.optimize import DEFAULT_CACHE_DIR, load_optimized_model, make_check_volume
+
+logger = logging.getLogger(__name__)
+
+# Default location of the WMH-SynthSeg release (https://surfer.nmr.mgh.harvard.edu/fswiki/WMH-SynthSeg)
+WMH_SYNTHSEG_DIR = '/usr/local/WMHSynthSeg'
+
+# Output labels of the network, in channel order (same constants as WMH-SynthSeg's inference.py)
+LABEL_LIST_SEGMENTATION = [0, 14, 15, 16, 24, 77, 85, 2, 3, 4, 5, 7, 8, 10, 11, 12, 13, 17, 18, 26, 28,
+                           41, 42, 43, 44, 46, 47, 49, 50, 51, 52, 53, 54, 58, 60]
+N_NEUTRAL_LABELS = 7
+
+
+class WMHSynthSeg(object):
+    """
+    In-process version of WMH-SynthSeg's `inference.py`.
+
+    The original script builds the network and loads its weights every time it is called. Here the model is loaded
+    once by `load` and `segment` can then be called for as many volumes as needed. The preprocessing uses the helpers
+    of the WMH-SynthSeg release (`utils.py`), as its network code, so that only the model loading differs from the
+    original script.
+
+    With `optimization`, the network is replaced by an optimized version (see `psb.inference.optimize`), built once
+    and cached in `cache_dir`. When it is built, its segmentations are compared with the ones of the reference
+    network (on `check_paths`, or a synthetic volume) and it is only used if the Dice of every label is at least
+    `min_dice`. The comparison is saved with the cached model and available in `accuracy`.
+    """
+
+    def __init__(self, wmh_dir=WMH_SYNTHSEG_DIR, model_path=None, device='auto', optimization='none', cache_dir=None,
+                 check_paths=None, min_dice=0.97):
+        """
+        :param wmh_dir: WMH-SynthSeg installation folder (contains `inference.py`, `unet3d` and the weights)
+        :param model_path: path to the `.pth` weights. If None, the weights are searched in `wmh_dir`
+        :param device: torch device used for the inference ('cpu', 'cuda' or 'auto': GPU if available, see\
+                       `resolve_device`)
+        :param optimization: 'none' (reference network), 'torchscript' or 'bfloat16'
+        :param cache_dir: folder of the optimized models (default: DEFAULT_CACHE_DIR)
+        :param check_paths: images used to check the optimized network when it is built
+        :param min_dice: minimum Dice per label of the optimized network against the reference one
+        """
+        self.wmh_dir = wmh_dir
+        self.model_path = model_path
+        self.device = device
+        self.optimization = optimization
+        self.cache_dir = cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR
+        self.check_paths = check_paths
+        self.min_dice = min_dice
+        self.model = None
+        self.network = None  # network used for the inference: `model` or its optimized version
+        self.accuracy = None
+        self.labels = None
+        self.helpers = None  # preprocessing helpers of WMH-SynthSeg (`utils.py` of `wmh_dir`)
+
+        n_labels = len(LABEL_LIST_SEGMENTATION)
+        n_lat = (n_labels - N_NEUTRAL_LABELS) // 2
+        # Channel permutation swapping left and right labels, used with the left/right flipped prediction
+        self.vflip = np.concatenate([np.arange(N_NEUTRAL_LABELS),
+                                     np.arange(N_NEUTRAL_LABELS + n_lat, n_labels),
+                                     np.arange(N_NEUTRAL_LABELS, N_NEUTRAL_LABELS + n_lat)])
+
+    def load(self):
+        """
+        Build the network and load its weights.
+        """
+        import torch
+
+        self.device = resolve_device(self.device)
+        if self.model_path is None:
+            self.model_path = find_model_path(self.wmh_dir)
+        if self.wmh_dir not in sys.path:
+            sys.path.insert(0, self.wmh_dir)
+        from unet3d.model import UNet3D
+        self.helpers = load_wmh_helpers(self.wmh_dir)
+
+        logger.info(f"Loading WMH-SynthSeg weights from {self.model_path} on {self.device}")
+        checkpoint = torch.load(self.model_path, map_location=self.device)
+        state_dict = checkpoint['model_state_dict']
+        out_channels = state_dict['final_conv.weight'].shape[0]
+        model = UNet3D(1, out_channels, final_sigmoid=False, f_maps=64, layer_order='gcl', num_groups=8,
+                       num_levels=5, is_segmentation=False, is_3d=True)
+        model.load_state_dict(state_dict)
+        self.model = model.to(self.device).eval()
+        self.network = self.model
+        self.labels = torch.tensor(LABEL_LIST_SEGMENTATION, device=self.device)
+        if self.optimization != 'none':
+            self.load_optimized()
+        return self
+
+    def load_optimized(self):
+        """
+        Load (or build and check) the optimized network, and use it if it is accurate enough.
+        """
+        import torch
+
+        def get_check_volumes():
+            # Only preprocessed when the check is run (model built, or checked on other images)
+            with torch.no_grad():
+                if self.check_paths:
+                    return [self.preprocess(path)[0][None, None, ...] for path in self.check_paths]
+                return [torch.tensor(make_check_volume(), device=self.device)[None, None, ...]]
+
+        network, self.accuracy = load_optimized_model(
+            self.model, self.model_path, self.optimization, get_check_volumes,
+            lambda net, volumes: self.predict(volumes, network=net), check_paths=self.check_paths,
+            cache_dir=self.cache_dir, device=self.device)
+
+        if self.accuracy['min_dice'] < self.min_dice:
+            logger.warning(f"The {self.optimization} model is not used: its minimum Dice against the reference model "
+                           f"is {self.accuracy['min_dice']:.4f} (< {self.min_dice})")
+        else:
+            logger.info(f"Using the {self.optimization} model (minimum Dice against the reference model: "
+                        f"{self.accuracy['min_dice']:.4f}, changed voxels: {self.accuracy['max_changed_voxels']:.2e})")
+            self.network = network
+
+    def segment(self, input_path, output_path):
+        """
+        Segment one volume and save the discrete segmentation (1 mm isotropic, RAS) to `output_path`.
+
+        :param input_path: path to the anatomical image
+        :param output_path: path of the output segmentation
+        """
+        import torch
+
+        if self.model is None:
+            self.load()
+        with torch.no_grad():
+            volume, crop, affine = self.preprocess(input_path)
+            seg = self.predict(volume[None, None, ...])[0]
+            seg = seg[crop].cpu().numpy().astype(np.uint8)
+        nib.save(nib.Nifti1Image(seg, affine), output_path)
+        return output_path
+
+    def segment_batch(self, input_paths, output_paths):
+        """
+        Segment several volumes, running the network once per group of volumes with the same padded shape (the
+        group normalization of the network does not mix the volumes of a batch, so each output is the same as with
+        `segment`).
+
+        :param input_paths: paths to the anatomical images
+        :param output_paths: paths of the output segmentations, in the same order
+        :return: list of the output paths
+        """
+        import torch
+
+        if self.model is None:
+            self.load()
+        groups = {}
+        with torch.no_grad():
+            for input_path, output_path in zip(input_paths, output_paths):
+                volume, crop, affine = self.preprocess(input_path)
+                groups.setdefault(tuple(volume.shape), []).append((volume, crop, affine, output_path))
+            for group in groups.values():
+                segs = self.predict(torch.stack([volume for volume, _, _, _ in group])[:, None, ...])
+                for seg, (_, crop, affine, output_path) in zip(segs, group):
+                    nib.save(nib.Nifti1Image(seg[crop].cpu().numpy().astype(np.uint8), affine), output_path)
+        return list(output_paths)
+
+    def preprocess(self, input_path):
+        """
+        Preprocess an image as WMH-SynthSeg's `inference.py` does, with its own helpers (`utils.py` of `wmh_dir`):
+        resample to 1 mm isotropic, align to RAS, normalize to [0, 1] and pad to a multiple of 32.
+
+        :return: padded volume (torch tensor), slices to crop the prediction back and the 1 mm affine
+        """
+        import torch
+
+        helpers = self.helpers if self.helpers is not None else load_wmh_helpers(self.wmh_dir)
+        im, aff = helpers.MRIread(input_path)
+        im = torch.tensor(np.squeeze(im), dtype=torch.float32, device=self.device)
+        while im.ndim > 3:
+            im = torch.mean(im, dim=-1)
+        im, aff = helpers.torch_resize(im, aff, 1.0, self.device)
+        im, aff = helpers.align_volume_to_ref(im, aff, aff_ref=np.eye(4), return_aff=True, n_dims=3)
+
+        # Normalize intensities
+        im = im - torch.min(im)
+        im = im / torch.max(im)
+
+        # Pad to a multiple of 32 for the U-Net
+        shape = np.array(im.shape[:3])
+        padded_shape = (np.ceil(shape / 32.0) * 32).astype(int)
+        idx = np.floor((padded_shape - shape) / 2).astype(int)
+        crop = tuple(slice(i, i + s) for i, s in zip(idx, shape))
+        padded = torch.zeros(*padded_shape, dtype=torch.float32, device=self.device)
+        padded[crop] = im
+        return padded, crop, aff
+
+    def predict(self, volumes, network=None):
+        """
+        Run the network (with left/right flip averaging) on a batch of preprocessed volumes.
+
+        :param volumes: torch tensor of shape (batch, 1, x, y, z)
+        :param network: network to run (default: the network used for the inference)
+        :return: discrete segmentation of shape (batch, x, y, z)
+        """
+        import torch
+
+        network = self.network if network is None else network
+        n_labels = len(LABEL_LIST_SEGMENTATION)
+        output = network(volumes)
+        output_flip = torch.flip(network(torch.flip(volumes, [2])), [2])
+        prob = 0.5 * torch.softmax(output[:, :n_labels, ...], dim=1) + \
+            0.5 * torch.softmax(output_flip[:, self.vflip, ...], dim=1)
+        return self.labels[torch.argmax(prob, dim=1)]
+
+
+def find_model_path(wmh_dir):
+    """
+    Return the path of the WMH-SynthSeg weights (`.pth`) available in `wmh_dir` (latest version if several).
+    """
+    model_files = sorted(glob.glob(os.path.join(wmh_dir, '*.pth')))
+    if not model_files:
+        raise FileNotFoundError(f"No WMH-SynthSeg weights (.pth) were found in {wmh_dir}")
+    return model_files[-1]
+
+
+def load_wmh_helpers(wmh_dir):
+    """
+    Import the preprocessing helpers of WMH-SynthSeg (`utils.py` of `wmh_dir`: MRIread, torch_resize,
+    align_volume_to_ref) under their own module name, so that they do not shadow another `utils` module.
+    """
+    import importlib.util
+
+    name = 'wmh_synthseg_utils'
+    path = os.path.join(wmh_dir, 'utils.py')
+    module = sys.modules.get(name)
+    if module is not None and getattr(module, '__file__', None) == path:
+        return module
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"The WMH-SynthSeg helpers (utils.py) were not found in {wmh_dir}")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[name] = module
+    return module
@@ -0,0 +1,365 @@
+import os
+import time
+import logging
+import threading
+import traceback
+import itertools
+import collections
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from concurrent.futures import Future
+
+from psb.utils.profiling import StageProfiler, NULL_PROFILER
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceWorker(object):
+    """
+    Pool of long-lived inference processes.
+
+    Each process builds its model once (`model_factory().load()`) and then serves jobs sent over a local pipe, so the
+    interpreter start, the imports and the weights loading are paid once per process instead of once per volume.
+    Jobs running longer than the timeout are killed and their process is replaced by a fresh one.
+
+    With `batch_size` > 1, the queued jobs are sent to a process in batches of up to `batch_size` volumes, which the
+    model runs through the network together (`segment_batch`). A partial batch is sent once its oldest job waited
+    `batch_timeout` seconds, so a single volume is not held back waiting for others.
+
+    The model returned by `model_factory` must implement `load()` and `segment(input_path, output_path)`, and
+    optionally `segment_batch(input_paths, output_paths)`.
+
+    Example:
+        with InferenceWorker(partial(WMHSynthSeg, device='cpu'), pool_size=2, timeout=600) as worker:
+            worker.predict('anat.nii', 'dseg.nii')
+    """
+
+    def __init__(self, model_factory, pool_size=1, timeout=None, batch_size=1, batch_timeout=1.0, backends=None):
+        """
+        :param model_factory: picklable callable returning the model served by each process
+        :param pool_size: number of inference processes (i.e. number of models kept in memory)
+        :param timeout: default per-job timeout in seconds (None: no timeout). A batch gets the sum of the timeouts\
+                        of its jobs
+        :param batch_size: maximum number of volumes sent at once to a process
+        :param batch_timeout: maximum time in seconds a job waits for a batch to be complete
+        :param backends: list of InferenceBackend (threads, core affinity), one per process, applied before the model\
+                         is loaded (see `plan_backends`). None: torch defaults
+        """
+        if pool_size < 1:
+            raise ValueError(f"pool_size must be at least 1, got {pool_size}")
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+        self.model_factory = model_factory
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.backends = backends if backends is not None else [None] * pool_size
+        if len(self.backends) != pool_size:
+            raise ValueError(f"Expected {pool_size} backends, got {len(self.backends)}")
+
+        self._ctx = mp.get_context('spawn')
+        self._processes = []
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._wakeup_r, self._wakeup_w = self._ctx.Pipe(duplex=False)
+        self._dispatcher = None
+        self._shutdown = False
+        self._broken = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def capacity(self):
+        """
+        Number of jobs processed at the same time when the processes are busy with full batches.
+        """
+        return self.pool_size * self.batch_size
+
+    def start(self):
+        """
+        Start the inference processes. The models are loaded in the background.
+        """
+        if self._dispatcher is None:
+            self._processes = [_WorkerProcess(self._ctx, self.model_factory, backend) for backend in self.backends]
+            self._dispatcher = threading.Thread(target=self._dispatch, name='InferenceWorker', daemon=True)
+            self._dispatcher.start()
+        return self
+
+    def submit(self, input_path, output_path, timeout=None, profiler=None):
+        """
+        Queue a volume for inference.
+
+        :param input_path: path to the anatomical image
+        :param output_path: path of the output segmentation
+        :param timeout: timeout in seconds for this job, counted from the moment a process picks it up\
+                        (default: the worker's timeout)
+        :param profiler: StageProfiler receiving the `inference` stage measured in the inference process\
+                         (added before the future is resolved)
+        :return: `concurrent.futures.Future` resolved with `output_path`
+        """
+        future = Future()
+        with self._lock:
+            if self._broken is not None:
+                raise RuntimeError(f"Inference worker is broken: {self._broken}")
+            if self._shutdown:
+                raise RuntimeError("Cannot submit new jobs after the inference worker was closed")
+            timeout = self.timeout if timeout is None else timeout
+            self._pending.append((next(self._job_ids), input_path, output_path, timeout, profiler, time.monotonic(),
+                                  future))
+        self.start()
+        self._wakeup()
+        return future
+
+    def predict(self, input_path, output_path, timeout=None):
+        """
+        Run the inference on one volume and wait for the result (see `submit`).
+        """
+        return self.submit(input_path, output_path, timeout=timeout).result()
+
+    def close(self, wait_jobs=True):
+        """
+        Stop the inference processes.
+
+        :param wait_jobs: if True, wait for the queued jobs to finish, otherwise cancel them
+        """
+        with self._lock:
+            self._shutdown = True
+            if not wait_jobs:
+                while self._pending:
+                    self._pending.popleft()[-1].cancel()
+        if self._dispatcher is not None:
+            self._wakeup()
+            self._dispatcher.join()
+            self._dispatcher = None
+
+    def _wakeup(self):
+        self._wakeup_w.send_bytes(b'')
+
+    def _dispatch(self):
+        """
+        Dispatcher thread: hand out queued jobs to idle processes, collect the results and enforce the timeouts.
+        """
+        try:
+            while True:
+                with self._lock:
+                    batch_delay = self._assign_jobs()
+                    busy = any(p.job is not None for p in self._processes)
+                    if self._broken is not None or (self._shutdown and not self._pending and not busy):
+                        break
+
+                deadlines = [p.deadline for p in self._processes if p.deadline is not None]
+                if batch_delay is not None:
+                    deadlines.append(time.monotonic() + batch_delay)
+                timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+                ready = wait([self._wakeup_r] + [p.conn for p in self._processes] +
+                             [p.process.sentinel for p in self._processes], timeout=timeout)
+
+                if self._wakeup_r in ready:
+                    while self._wakeup_r.poll():
+                        self._wakeup_r.recv_bytes()
+                for idx, proc in enumerate(self._processes):
+                    if proc.conn in ready or proc.process.sentinel in ready:
+                        self._processes[idx] = self._handle_messages(proc)
+                    if proc.deadline is not None and time.monotonic() > proc.deadline:
+                        self._processes[idx] = self._handle_timeout(proc)
+        finally:
+            self._stop_processes()
+
+    def _assign_jobs(self):
+        """
+        Send batches of queued jobs to the idle processes.
+
+        :return: time in seconds before a partial batch has to be sent (None: no partial batch waiting)
+        """
+        for proc in self._processes:
+            while self._pending and proc.ready and proc.job is None:
+                if len(self._pending) < self.batch_size and not self._shutdown:
+                    delay = self._pending[0][5] + self.batch_timeout - time.monotonic()
+                    if delay > 0:
+                        return delay
+                batch = []
+                timeouts = []
+                while self._pending and len(batch) < self.batch_size:
+                    job_id, input_path, output_path, timeout, profiler, _, future = self._pending.popleft()
+                    if future.set_running_or_notify_cancel():
+                        batch.append((job_id, input_path, output_path, profiler, future))
+                        timeouts.append(timeout)
+                if not batch:
+                    continue
+                proc.conn.send([(job_id, input_path, output_path, profiler is not None and profiler.enabled)
+                                for job_id, input_path, output_path, profiler, _ in batch])
+                proc.job = [(job_id, input_path, profiler, future) for job_id, input_path, _, profiler, future in batch]
+                proc.deadline = time.monotonic() + sum(timeouts) if None not in timeouts else None
+        return None
+
+    def _handle_messages(self, proc):
+        try:
+            while proc.conn.poll():
+                status, payload = proc.conn.recv()
+                if status == 'ready':
+                    proc.ready = True
+                    logger.info(f"Inference process {proc.process.pid} is ready ({payload[1]})")
+                elif status == 'load_error':
+                    self._set_broken(f"model loading failed:\n{payload}")
+                elif status == 'done':
+                    # One (status, payload) per job of the batch
+                    for (_, input_path, profiler, future), (job_status, job_payload) in zip(proc.pop_job(), payload):
+                        if job_status == 'done':
+                            result, records = job_payload
+                            if records:
+                                profiler.add(records)
+                            future.set_result(result)
+                        else:
+                            future.set_exception(RuntimeError(f"Inference failed on {input_path}:\n{job_payload}"))
+        except (EOFError, OSError):
+            pass
+
+        if not proc.process.is_alive():
+            if not proc.ready:
+                self._set_broken(f"inference process exited with code {proc.process.exitcode} before being ready")
+                return proc
+            if proc.job is not None:
+                for _, input_path, _, future in proc.pop_job():
+                    future.set_exception(RuntimeError(f"Inference process died (exit code {proc.process.exitcode}) "
+                                                      f"while processing {input_path}"))
+            proc.close()
+            return _WorkerProcess(self._ctx, self.model_factory, proc.backend)
+        return proc
+
+    def _handle_timeout(self, proc):
+        jobs = proc.pop_job()
+        input_paths = ', '.join(input_path for _, input_path, _, _ in jobs)
+        logger.warning(f"Inference on {input_paths} timed out, restarting process {proc.process.pid}")
+        proc.kill()
+        for _, input_path, _, future in jobs:
+            future.set_exception(TimeoutError(f"Inference on {input_path} timed out"))
+        return _WorkerProcess(self._ctx, self.model_factory, proc.backend)
+
+    def _set_broken(self, reason):
+        logger.error(f"Inference worker is broken: {reason}")
+        self._broken = reason
+        error = RuntimeError(f"Inference worker is broken: {reason}")
+        with self._lock:
+            pending = [job[-1] for job in self._pending]
+            self._pending.clear()
+        for future in pending:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+        for proc in self._processes:
+            if proc.job is not None:
+                for _, _, _, future in proc.pop_job():
+                    future.set_exception(error)
+
+    def _stop_processes(self):
+        for proc in self._processes:
+            proc.close()
+        self._processes = []
+
+
+class _WorkerProcess(object):
+    """
+    Handle on one inference process and the job it is currently running.
+    """
+
+    def __init__(self, ctx, model_factory, backend=None):
+        self.backend = backend
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_serve, args=(model_factory, child_conn, backend), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.job = None
+        self.deadline = None
+
+    def pop_job(self):
+        """
+        :return: the jobs of the batch being processed, as (job_id, input_path, profiler, future)
+        """
+        jobs = self.job
+        self.job = None
+        self.deadline = None
+        return jobs
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+        self.conn.close()
+
+
+def _serve(model_factory, conn, backend=None):
+    """
+    Main loop of an inference process: apply the backend settings, load the model once, then run batches of jobs
+    until a None batch is received.
+    """
+    try:
+        info = {}
+        if backend is not None:
+            backend.setup()
+            info.update(backend.get_info())
+        model = model_factory()
+        model.load()
+        if getattr(model, 'device', None) is not None:
+            info['device'] = str(model.device)
+    except BaseException:
+        conn.send(('load_error', traceback.format_exc()))
+        return
+    conn.send(('ready', (os.getpid(), info)))
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        conn.send(('done', _run_batch(model, job, info)))
+
+
+def _run_batch(model, jobs, info=None):
+    """
+    Run a batch of jobs, with one call to `model.segment_batch` when the model has it. If the batch fails, the jobs
+    are run one by one so that the error is reported for the right volume only.
+
+    :param info: settings of the process (device, threads) saved with the profile records
+
+    :return: list of ('done', (result, records)) or ('error', traceback), one per job
+    """
+    if len(jobs) > 1 and hasattr(model, 'segment_batch'):
+        profiler = StageProfiler() if any(job[3] for job in jobs) else NULL_PROFILER
+        try:
+            with profiler.stage('inference', batch_size=len(jobs), **(info or {})):
+                results = model.segment_batch([job[1] for job in jobs], [job[2] for job in jobs])
+            return [('done', (result, list(profiler.records) if job[3] else []))
+                    for job, result in zip(jobs, results)]
+        except Exception:
+            logger.warning(f"Batched inference failed, running the {len(jobs)} volumes one by one:\n"
+                           f"{traceback.format_exc()}")
+
+    results = []
+    for _, input_path, output_path, profile in jobs:
+        profiler = StageProfiler() if profile else NULL_PROFILER
+        try:
+            with profiler.stage('inference', **(info or {})):
+                result = model.segment(input_path, output_path)
+            results.append(('done', (result, list(profiler.records))))
+        except Exception:
+            results.append(('error', traceback.format_exc()))
+    return results
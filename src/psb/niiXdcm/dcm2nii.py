@@ -1,8 +1,10 @@
 import os
+import glob
 import dicom2nifti
+import dicom2nifti.convert_dicom
+import dicom2nifti.settings
 import pydicom
 import numpy as np
-import glob
 
 from psb.utils.image import Image
 
@@ -20,6 +22,35 @@ def convert_dicom_to_nifti(dicom_dir, output_folder, compression=True, reorient=
             img.save(file_path)
 
 
+def convert_dicom_files_to_image(dicom_files):
+    """
+    Convert the files of a single DICOM series to an `Image` in the orientation of the DICOM, in memory.
+
+    :param dicom_files: list of the DICOM files of the series
+    :return: Image
+    """
+    datasets = [pydicom.dcmread(f, defer_size="1 KB", force=dicom2nifti.settings.pydicom_read_force) for f in dicom_files]
+    return convert_datasets_to_image(datasets)
+
+
+def convert_datasets_to_image(datasets):
+    """
+    Convert the datasets of one DICOM series to an `Image` in the orientation of the DICOM.
+
+    :param datasets: list of pydicom datasets of a single series
+    :return: Image
+    """
+    results = dicom2nifti.convert_dicom.dicom_array_to_nifti(datasets, None, reorient_nifti=False)
+    nii = results['NII']
+    img = Image(np.asanyarray(nii.dataobj), hdr=nii.header)
+
+    dcm_ori_matrix = get_orientation_matrix_from_dataset(datasets[0])
+    orig_orientation = read_orientation(switch_convention_orientation_matrix(dcm_ori_matrix))
+    if img.orientation != orig_orientation:
+        img.change_orientation(orig_orientation)
+    return img
+
+
 def read_orientation(ori_matrix, convention='nifti'):
     """
     Read orientation from an orientation matrix
@@ -78,7 +109,13 @@ def get_orientation_matrix_from_dicom(dicom_dir):
     """
     From an input DICOMN file, extract the orientation matrix and return the rounded matrix
     """
-    dicom_metadata = read_dicom_metadata(dicom_dir)
+    return get_orientation_matrix_from_dataset(read_dicom_metadata(dicom_dir))
+
+
+def get_orientation_matrix_from_dataset(dicom_metadata):
+    """
+    From a DICOM dataset, extract the orientation matrix and return the rounded matrix
+    """
     Ax, Ay, Az, Bx, By, Bz = dicom_metadata.get((0x0020,0x0037)).value
     dcm_ori_matrix = np.array([[Ax, Ay, Az],[Bx, By, Bz]]).transpose()
     C = np.expand_dims(np.cross(dcm_ori_matrix[:,0],dcm_ori_matrix[:,1]), axis=-1)
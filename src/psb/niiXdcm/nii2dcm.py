@@ -1,31 +1,120 @@
+import json
 import SimpleITK as sitk
 import pydicom
 import pydicom_seg
 import numpy as np
 
 
-def convert_nifti_seg_to_dicom_seg(dcm_path_input, seg_image, template_path):
+class DicomSeries(object):
+    """
+    Source DICOM series of a segmentation, read once and shared by every DICOM-SEG written for this series.
+
+    Holds the sorted file list, the header-only datasets (pixel data is never decoded) and the geometry of the
+    volume that `sitk.ImageSeriesReader` would return (origin, spacing and direction).
+    """
+
+    def __init__(self, dcm_path_input, series_uid=''):
+        """
+        :param dcm_path_input: DICOM input folder
+        :param series_uid: SeriesInstanceUID of the series to read if the folder has several (default: first series)
+        """
+        self.path = dcm_path_input
+        self.files = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(dcm_path_input, series_uid)
+        if not self.files:
+            raise ValueError(f"No DICOM series found in {dcm_path_input}")
+        self.datasets = [pydicom.dcmread(x, stop_before_pixels=True) for x in self.files]
+        self.size, self.origin, self.spacing, self.direction = get_series_geometry(self.datasets)
+
+    def copy_information(self, image):
+        """
+        Copy the series geometry to a SimpleITK image (same as `image.CopyInformation(series_image)`).
+        """
+        if tuple(image.GetSize()) != self.size:
+            raise ValueError(f"Segmentation size {image.GetSize()} does not match the DICOM series size {self.size}")
+        image.SetOrigin(self.origin)
+        image.SetSpacing(self.spacing)
+        image.SetDirection(self.direction)
+        return image
+
+
+def get_series_geometry(datasets):
+    """
+    Compute the geometry of a sorted single-frame DICOM series from its headers, the same way ITK's series reader
+    does (ITK 5.4): in-plane axes from ImageOrientationPatient, slice axis orthogonal to them, and slice spacing as
+    the mean distance between slices, from the first and last ImagePositionPatient (so that a series with
+    non-uniform sampling or missing slices gets the same grid as `sitk.ImageSeriesReader`).
+
+    :param datasets: list of pydicom datasets sorted along the slice axis
+    :return: size, origin, spacing and direction (flattened 3x3, row-major) as tuples
+    """
+    first = datasets[0]
+    iop = np.array(first.ImageOrientationPatient, dtype=float)
+    row_dir, col_dir = iop[:3], iop[3:]
+    origin = np.array(first.ImagePositionPatient, dtype=float)
+
+    # ITK forces an orthogonal direction (ForceOrthogonalDirection, on by default)
+    slice_dir = np.cross(row_dir, col_dir)
+    slice_spacing = 1.0
+    if len(datasets) > 1:
+        dir_n = np.array(datasets[-1].ImagePositionPatient, dtype=float) - origin
+        norm = np.linalg.norm(dir_n) / (len(datasets) - 1)
+        if not np.isclose(norm, 0):
+            slice_spacing = norm
+
+    size = (int(first.Columns), int(first.Rows), len(datasets))
+    spacing = (float(first.PixelSpacing[1]), float(first.PixelSpacing[0]), float(slice_spacing))
+    direction = np.stack([row_dir, col_dir, slice_dir], axis=1)
+    return size, tuple(origin.tolist()), spacing, tuple(direction.ravel().tolist())
+
+
+def convert_nifti_seg_to_dicom_seg(dcm_path_input, seg_image, template_path, compact=False):
     '''
-    :param dcm_path_input: DICOM input folder used to extract metadata
-    :param seg_image: Image object
-    :param template_path: template path
+    :param dcm_path_input: DicomSeries of the source images (or DICOM input folder) used to extract metadata
+    :param seg_image: Image object (labels numbered as the segments of the template: 1, 2, ...)
+    :param template_path: template path, or dcmqi metainfo dict (see `build_multi_segment_metainfo`)
+    :param compact: if True, the frames are cropped to the bounding box of the segmentation and the empty frames and
+                    segments are not written (smaller files, the frames keep their position so viewers place them
+                    correctly). If False, every segment has a full-size frame for every slice of the series
     '''
+    dcm_series = dcm_path_input if isinstance(dcm_path_input, DicomSeries) else DicomSeries(dcm_path_input)
     template = pydicom_seg.template.from_dcmqi_metainfo(template_path)
-    writer = pydicom_seg.MultiClassWriter(template=template, inplane_cropping=False, skip_empty_slices=False, skip_missing_segment=False)
-    reader = sitk.ImageSeriesReader()
-    dcm_files = reader.GetGDCMSeriesFileNames(dcm_path_input)
-    reader.SetFileNames(dcm_files)
-    dcm_reader = reader.Execute()
-    
-    # Change orientation itksnap
-    seg_image.change_orientation(reverse_orientation_itksnap(seg_image.orientation))
+    writer = pydicom_seg.MultiClassWriter(template=template, inplane_cropping=compact, skip_empty_slices=compact,
+                                          skip_missing_segment=compact)
+
+    # Change orientation itksnap (C-contiguous, the memory layout expected by SimpleITK)
+    seg_image.change_orientation(reverse_orientation_itksnap(seg_image.orientation), order='C')
 
     # Create dicom_seg object
     seg_sitk = sitk.GetImageFromArray(seg_image.data)
-    seg_sitk.CopyInformation(dcm_reader)
+    dcm_series.copy_information(seg_sitk)
 
-    dcm_source_images = [pydicom.dcmread(x, stop_before_pixels=True) for x in dcm_files]
-    return writer.write(seg_sitk, dcm_source_images)
+    return writer.write(seg_sitk, dcm_series.datasets)
+
+
+def build_multi_segment_metainfo(template_paths, description=None):
+    '''
+    Merge single-segment dcmqi templates into the template of one multi-segment DICOM-SEG: segment i (from 1) is
+    the segment of `template_paths[i - 1]`. The other attributes come from the first template.
+
+    :param template_paths: paths of the per-label templates, in segment order
+    :param description: SeriesDescription and ContentDescription of the DICOM-SEG (default: kept from the first template)
+    :return: dcmqi metainfo dict
+    '''
+    metainfo = None
+    segments = []
+    for template_path in template_paths:
+        with open(template_path, 'r') as f:
+            template = json.load(f)
+        if metainfo is None:
+            metainfo = template
+        for attributes in template['segmentAttributes'][0]:
+            segments.append(dict(attributes, labelID=len(segments) + 1))
+    if metainfo is None:
+        raise ValueError("At least one template is needed")
+    metainfo = dict(metainfo, segmentAttributes=[segments])
+    if description is not None:
+        metainfo.update(SeriesDescription=description, ContentDescription=description)
+    return metainfo
 
 
 def reverse_orientation_itksnap(orientation):
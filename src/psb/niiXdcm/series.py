@@ -0,0 +1,152 @@
+import os
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+
+logger = logging.getLogger(__name__)
+
+# Tags read from each file to build the series manifest
+INDEX_TAGS = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'Modality', 'Rows', 'Columns']
+
+
+class SeriesInfo(object):
+    """
+    Entry of the series manifest: one DICOM series of a leaf folder.
+    """
+
+    def __init__(self, uid, folder, files, modality=None, rows=None, columns=None, number=None, description=None):
+        self.uid = uid
+        self.folder = folder
+        self.files = files
+        self.modality = modality
+        self.rows = rows
+        self.columns = columns
+        self.number = number
+        self.description = description
+        # Set by `index_dicom_series`: unique name of the series in its folder and whether the folder has other series
+        self.name = None
+        self.shared_folder = False
+
+    @property
+    def slice_count(self):
+        return len(self.files)
+
+    @property
+    def dim(self):
+        return self.columns, self.rows, self.slice_count
+
+    def to_dict(self):
+        return {
+            'uid': self.uid,
+            'folder': self.folder,
+            'name': self.name,
+            'files': self.files,
+            'slice_count': self.slice_count,
+            'modality': self.modality,
+            'dim': self.dim,
+            'number': self.number,
+            'description': self.description,
+        }
+
+    def __repr__(self):
+        return f"SeriesInfo({self.folder}, {self.name}, {self.slice_count} files)"
+
+
+def scan_leaf_folders(root, extension='.dcm'):
+    """
+    Walk a tree with `os.scandir` and list the files of every leaf folder (folder without subfolders) in one pass.
+
+    :param root: root folder
+    :param extension: only files with this extension are listed (None: all files)
+    :return: dict {leaf folder: sorted list of file paths}
+    """
+    leaves = {}
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        files = []
+        has_subfolders = False
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        has_subfolders = True
+                        stack.append(entry.path)
+                    elif entry.is_file() and (extension is None or entry.name.endswith(extension)):
+                        files.append(entry.path)
+        except OSError as e:
+            logger.warning(f"Unable to list {folder}: {e}")
+            continue
+        if not has_subfolders:
+            leaves[folder] = sorted(files)
+    return dict(sorted(leaves.items()))
+
+
+def index_dicom_series(root, threads=8, extension='.dcm', folders=None):
+    """
+    Index the DICOM series of a tree: leaf folders are listed in one pass, then the files are grouped by
+    SeriesInstanceUID using header-only reads (a few tags, no pixel data) spread over a thread pool.
+
+    A leaf folder holding several series gives several entries.
+
+    :param root: root folder of the DICOM tree
+    :param threads: number of threads reading the headers
+    :param extension: extension of the DICOM files
+    :param folders: dict {leaf folder: files} as returned by `scan_leaf_folders` (default: scan `root`)
+    :return: list of SeriesInfo (series manifest)
+    """
+    if folders is None:
+        folders = scan_leaf_folders(root, extension=extension)
+    all_files = [f for files in folders.values() for f in files]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        headers = dict(zip(all_files, executor.map(_read_index_header, all_files)))
+
+    manifest = []
+    for folder, files in folders.items():
+        folder_series = {}
+        for file in files:
+            ds = headers[file]
+            if ds is None or 'SeriesInstanceUID' not in ds:
+                continue
+            uid = str(ds.SeriesInstanceUID)
+            if uid not in folder_series:
+                folder_series[uid] = SeriesInfo(uid, folder, [], modality=ds.get('Modality'), rows=ds.get('Rows'),
+                                                columns=ds.get('Columns'), number=_to_str(ds.get('SeriesNumber')),
+                                                description=_to_str(ds.get('SeriesDescription')))
+            folder_series[uid].files.append(file)
+
+        names = set()
+        for series in folder_series.values():
+            series.name = get_unique_series_name(series, names)
+            series.shared_folder = len(folder_series) > 1
+            manifest.append(series)
+    return manifest
+
+
+def get_unique_series_name(series, names):
+    """
+    Name of a series unique among `names` (updated): <SeriesNumber>_<SeriesDescription> or the SeriesInstanceUID.
+    """
+    if series.number:
+        name = f"{series.number}_{series.description}" if series.description else series.number
+    else:
+        name = series.uid
+    name = re.sub(r'[^\w.-]+', '_', name)
+    if name in names:
+        name = f"{name}_{series.uid}"
+    names.add(name)
+    return name
+
+
+def _read_index_header(file_path):
+    try:
+        return pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=INDEX_TAGS, force=True)
+    except Exception as e:
+        logger.warning(f"Unable to read: {file_path} ({e})")
+        return None
+
+
+def _to_str(value):
+    return None if value is None else str(value)
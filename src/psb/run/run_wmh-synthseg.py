@@ -11,19 +11,43 @@
 # Authors: Nilser Laines Medina, Nathan Molinier, Julien Cohen-Adad
 #
 import os
+import sys
+import signal
 import argparse
 import warnings
-import subprocess
-import glob
 import json
-import numpy as np
 import logging
 import coloredlogs
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
-from psb.utils.utils import get_last_folders_in_branches, count_files_in_folder, create_directory, tmp_create, rmtree
-from psb.niiXdcm.dcm2nii import convert_dicom_to_nifti
-from psb.niiXdcm.nii2dcm import convert_nifti_seg_to_dicom_seg
-from psb.utils.image import Image, zeros_like
+from psb.utils.utils import create_directory, SeriesLogger, Workspace
+from psb.utils.manifest import RunManifest
+from psb.utils.watch import InboxWatcher
+from psb.utils.profiling import StageProfiler, RunProfile, NULL_PROFILER, call_profiled
+from psb.utils.pipeline import StagedPipeline, PipelineStage
+from psb.niiXdcm.dcm2nii import convert_dicom_files_to_image
+from psb.niiXdcm.series import index_dicom_series, scan_leaf_folders
+from psb.niiXdcm.nii2dcm import convert_nifti_seg_to_dicom_seg, build_multi_segment_metainfo, DicomSeries
+from psb.utils.image import Image, split_labels, number_labels, resample_nearest
+from psb.inference.worker import InferenceWorker
+from psb.inference.backend import DEVICES, plan_backends
+from psb.inference.optimize import OPTIMIZATIONS, DEFAULT_CACHE_DIR
+from psb.inference.wmh_synthseg import WMHSynthSeg, WMH_SYNTHSEG_DIR
+
+
+# DICOM-SEG output modes
+SEG_OUTPUTS = ('per-label', 'multi')
+
+# DICOM-SEG encodings (see `convert_nifti_seg_to_dicom_seg`)
+SEG_ENCODINGS = ('full', 'compact')
+
+# Output file of the multi-segment mode, in the output folder of the series
+MULTI_SEG_NAME = 'WMH_SynthSeg.dcm'
+
+# Files written in the output folder of a series (per-label and multi-segment modes)
+SEG_OUTPUT_PATTERNS = ('*_WMH_SynthSeg.dcm', MULTI_SEG_NAME)
 
 
 def get_parser():
@@ -32,6 +56,32 @@ def get_parser():
     parser.add_argument('--dcm-in', type=str, required=True, help='Path to input directory with DICOM files (anat)')
     parser.add_argument('--dcm-out', type=str, required=True, help='Path to output directory for DICOM segmentation(s)')
     parser.add_argument('--min-dcm', type=int, default=40, help='Minimum number (int) of slices computed by the model. Default=40')
+    parser.add_argument('--wmh-dir', type=str, default=WMH_SYNTHSEG_DIR, help=f'WMH-SynthSeg installation folder. Default={WMH_SYNTHSEG_DIR}')
+    parser.add_argument('--device', type=str, default='auto', choices=DEVICES, help='Device of the inference: cpu, cuda, or auto (cuda if a GPU is available, cpu otherwise). Default=auto')
+    parser.add_argument('--threads', type=int, default=None, help='Number of intra-op threads of each inference process. Default: on CPU, the cores not reserved, split between the inference processes')
+    parser.add_argument('--interop-threads', type=int, default=None, help='Number of inter-op threads of each inference process. Default: torch default')
+    parser.add_argument('--reserved-cores', type=int, default=None, help='Number of cores left to the DICOM conversion and export (not used by the inference). Default=2 x --jobs (the conversion and the export each have --jobs workers), at most the cores not needed by one core per inference process')
+    parser.add_argument('--pin-cores', action='store_true', help='Pin each inference process to its own cores')
+    parser.add_argument('--optimize', type=str, default='none', choices=OPTIMIZATIONS, help='Optimized network used for the inference: torchscript (traced and frozen, float32) or bfloat16 (for CPUs with bfloat16 instructions). Built once and cached in --model-cache-dir. Default=none')
+    parser.add_argument('--model-cache-dir', type=str, default=DEFAULT_CACHE_DIR, help=f'Folder of the optimized networks. Default={DEFAULT_CACHE_DIR}')
+    parser.add_argument('--optimize-check', type=str, nargs='+', default=None, help='NIfTI images used to compare the optimized network with the reference one when it is built. Default: a synthetic volume')
+    parser.add_argument('--optimize-min-dice', type=float, default=0.97, help='Minimum Dice per label of the optimized network against the reference one, otherwise the reference network is used. Default=0.97')
+    parser.add_argument('--inference-workers', type=int, default=1, help='Number of inference processes, each one keeps a loaded model. Default=1')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of series converted, and of series exported, in parallel (one process pool per stage). Default=1')
+    parser.add_argument('--queue-size', type=int, default=2, help='Maximum number of series waiting for each stage (conversion, inference, export), bounds the memory used. Default=2')
+    parser.add_argument('--index-threads', type=int, default=8, help='Number of threads reading the DICOM headers to index the series. Default=8')
+    parser.add_argument('--tmp-dir', type=str, default=None, help='Folder for the temporary files, e.g. a RAM-backed folder such as /dev/shm. Default: system temporary folder')
+    parser.add_argument('--tmp-quota', type=float, default=None, help='Maximum size (in MB) of the temporary files of one series, the series fails if exceeded. Default=None (no limit)')
+    parser.add_argument('--force', action='store_true', help='Process every series, even the ones whose outputs are up to date in the manifest of --dcm-out')
+    parser.add_argument('--watch', action='store_true', help='Keep running and segment the series as they arrive in --dcm-in (stop with Ctrl+C or SIGTERM)')
+    parser.add_argument('--poll-interval', type=float, default=10, help='With --watch, time (in seconds) between two scans of --dcm-in. Default=10')
+    parser.add_argument('--settle-time', type=float, default=60, help='With --watch, time (in seconds) without new files after which a series is considered complete. Default=60')
+    parser.add_argument('--seg-output', type=str, default='per-label', choices=SEG_OUTPUTS, help='DICOM-SEG output: one file per label present (per-label), or one file per series with a segment per label present (multi). Default=per-label')
+    parser.add_argument('--seg-encoding', type=str, default='full', choices=SEG_ENCODINGS, help='DICOM-SEG encoding: full-size frames for every slice (full), or frames cropped to the segmentation without the empty ones (compact, smaller files). Default=full')
+    parser.add_argument('--profile', action='store_true', help='Record the time, CPU, I/O and memory of each stage in a JSON report per series and a run summary (in <dcm-out>/psb_profile)')
+    parser.add_argument('--inference-batch-size', type=int, default=1, help='Maximum number of volumes run through the model at once by an inference process. Default=1 (no batching)')
+    parser.add_argument('--inference-batch-timeout', type=float, default=1.0, help='Maximum time (in seconds) a volume waits for its inference batch to be complete. Default=1')
+    parser.add_argument('--inference-timeout', type=float, default=None, help='Maximum inference time (in seconds) for one image, the image is skipped if exceeded. Default=None (no limit)')
     return parser
 
 
@@ -39,9 +89,8 @@ def run_wmh_synthseg():
     parser = get_parser()
     args = parser.parse_args()
 
-    # Set logging level
-    logging.basicConfig(level=logging.WARNING)
-    coloredlogs.install(fmt='%(message)s', level='WARNING')
+    # Set logging level and deactivate pydicom_seg warnings
+    init_process()
 
     # Load wmh label dictionary
     label_wmh_path = 'src/psb/labels/WMH-SynthSeg/label-maps.json'
@@ -49,113 +98,407 @@ def run_wmh_synthseg():
     with open(label_wmh_path, "r") as f:
         label_dict = json.load(f)
 
-    # Deactivate pydicom_seg warnings
-    warnings.filterwarnings("ignore", category=UserWarning, module="pydicom.valuerep")
-
     dcm_in = os.path.abspath(args.dcm_in)
     dcm_out = os.path.abspath(args.dcm_out)
     min_dcm = args.min_dcm
+    temp_folder_name = os.path.basename(os.path.normpath(dcm_out) + "_temp")
+    workspace_factory = partial(Workspace, temp_folder_name, root=args.tmp_dir,
+                                max_bytes=int(args.tmp_quota * 1024 ** 2) if args.tmp_quota is not None else None)
 
-    last_folders_in_branches = get_last_folders_in_branches(dcm_in)
-    for last_subfolder in last_folders_in_branches:
-        file_count = count_files_in_folder(last_subfolder)
-        if min_dcm <= file_count :
-            print('')
-            print(f'================ The folder {last_subfolder} has: {file_count} .dcm files. ================')
-            print('')
-
-            # Init paths
-            folder_basename = os.path.basename(dcm_in)
-            input_folder = os.path.normpath(last_subfolder)
-
-            # Fetch folder structure
-            if os.path.basename(input_folder) != folder_basename:
-                folder_structure = os.path.join(folder_basename, input_folder.split(f'/{folder_basename}/')[-1])
+    # Series already processed by a previous run with the same inputs are skipped
+    run_manifest = RunManifest(dcm_out, labels=label_dict, min_dcm=min_dcm, force=args.force,
+                               options={'seg_output': args.seg_output, 'seg_encoding': args.seg_encoding,
+                                        'optimize': args.optimize, 'optimize_min_dice': args.optimize_min_dice},
+                               output_patterns=SEG_OUTPUT_PATTERNS)
+    run_profile = RunProfile(os.path.join(dcm_out, 'psb_profile')) if args.profile else None
+
+    # Start the inference processes once, the model is then reused for every image.
+    # The cores not reserved for the conversion and export (each with `jobs` workers) are split between the inference
+    # processes (plan_backends keeps at least one core per inference process)
+    model_factory = partial(WMHSynthSeg, wmh_dir=args.wmh_dir, device=args.device, optimization=args.optimize,
+                            cache_dir=args.model_cache_dir, min_dice=args.optimize_min_dice,
+                            check_paths=[os.path.abspath(path) for path in args.optimize_check] if args.optimize_check else None)
+    backends = plan_backends(args.inference_workers, device=args.device, threads=args.threads,
+                             interop_threads=args.interop_threads, pin=args.pin_cores,
+                             reserved_cores=2 * args.jobs if args.reserved_cores is None else args.reserved_cores)
+    with InferenceWorker(model_factory, pool_size=args.inference_workers, timeout=args.inference_timeout,
+                         batch_size=args.inference_batch_size, batch_timeout=args.inference_batch_timeout,
+                         backends=backends) as worker:
+        # The conversion and the export have their own pool, so that they overlap with each other and with the inference
+        with create_executor(args.jobs) as prepare_executor, create_executor(args.jobs) as export_executor:
+            pipeline = partial(run_pipeline, dcm_in, dcm_out, min_dcm, label_dict, template_dir, workspace_factory, worker,
+                               (prepare_executor, export_executor), args.jobs, index_threads=args.index_threads,
+                               run_manifest=run_manifest, run_profile=run_profile, queue_size=args.queue_size,
+                               seg_output=args.seg_output, compact=args.seg_encoding == 'compact')
+            if args.watch:
+                watcher = InboxWatcher(dcm_in, settle_time=args.settle_time, poll_interval=args.poll_interval)
+                failures = run_watch(pipeline, watcher)
             else:
-                folder_structure = folder_basename
-            
-            # Create output path
-            output_folder = os.path.join(dcm_out, folder_structure)
-
-            # Create output folder if does not exists
-            create_directory(output_folder)
-            print('output_folder !:', output_folder)
-
-            # Create a temporary folder
-            temp_folder_name = os.path.basename(os.path.normpath(dcm_out) + "_temp")
-            tmpdir = tmp_create(basename=temp_folder_name)
-
-            # Convert DICOM to NIfTI
-            convert_dicom_to_nifti(input_folder, tmpdir, reorient=False)
-            nifti_files_all = glob.glob(os.path.join(tmpdir, '*.nii.gz'))
-
-            if len(nifti_files_all) > 1:
-                logging.warning('Multiple images were detected')
-            
-            # For each generated files
-            for nifti_anat_path in nifti_files_all:
-
-                # Create temporary files paths
-                temp_dseg = os.path.join(tmpdir, 'dseg.nii.gz') 
-                temp_dseg_res = os.path.join(tmpdir, 'dseg_res.nii.gz') 
-
-                # Load image for shape
-                image_shape_nii = Image(nifti_anat_path)
-
-                # Validation between the number of Dicom images and the anatomical slices.
-                num_dcm_files = count_files_in_folder(input_folder)
-                if image_shape_nii.data.shape[2] == num_dcm_files:
-                        
-                    print('')
-                    print(f'=========================== Starting inference with WMH-SynthSeg ==========================')
-                    print('')
-
-                    # To test the script, you can try using bet2 to segment only the brain.
-                    command_1 = f"python3 /usr/local/WMHSynthSeg/inference.py --i {nifti_anat_path} --o {temp_dseg} --device cuda"
-                    # Run inference using a subprocess
-                    subprocess.run(command_1, shell=True)
-
-                    # Reslincing of the output (mask) to the anat image
-                    command_2 = f"mri_vol2vol --mov {temp_dseg} --targ {nifti_anat_path} --o {temp_dseg_res} --regheader --nearest "
-                    # Run inference using a subprocess
-                    subprocess.run(command_2, shell=True)
-
-                    # Load image
-                    image_out_nii = Image(temp_dseg_res)
-                    # Split the multiple discrete segmentation (dseg)
-                    for key, val in label_dict.items():
-                        intensity = val
-                        label_name = key
-                        mask = zeros_like(image_out_nii)
-                        mask.data = (image_out_nii.data).astype(np.uint8)   
-                        mask.data[np.where(mask.data != intensity)] = 0
-                        mask.data = np.where(mask.data > 0, 1, 0).astype(np.uint8)   
-                       
-                        template_path = os.path.join(template_dir, f'{label_name}.json')
-
-                        # Save each class in different files
-                        if np.max(mask.data) != 0:
-                            output_file_path = os.path.join(output_folder, f"{str(intensity).zfill(2)}_{label_name}_WMH_SynthSeg.dcm")
-                            dcm_seg_file = convert_nifti_seg_to_dicom_seg(input_folder, mask, template_path)
-                            dcm_seg_file.save_as(output_file_path)
-                            print('DICOM segmentation saved on : ',  output_file_path)
-                            print('')
-                        else:
-                            print(f"Label - {intensity} - {label_name} Does Not Exist")
-                        
-                    # Delete the temporary folder
-                    rmtree(tmpdir)
-
-                    print('')
-                    print(f" Temporary file {temp_folder_name} was deleted" )
-                    print('')
-
-                else: 
-                    logging.warning(f'Different number of slices with the original DICOM (possible GRE, DTI, fMRI).')
+                failures = pipeline()
+
+    if failures:
+        log_failures(failures)
+        sys.exit(1)
+
+
+def run_watch(pipeline, watcher):
+    """
+    Watch mode: run `pipeline` on the series folders of the inbox as soon as they are complete, until the watcher is
+    stopped (Ctrl+C or SIGTERM). The complete folders are fed to a single running pipeline, so a new series starts as
+    soon as there is room for it, while the previous ones are still in the pipeline.
+
+    :param pipeline: callable running the pipeline (see `run_pipeline`)
+    :param watcher: InboxWatcher of the input folder
+    :return: list of (series, exception) for the series that failed
+    """
+    # SIGTERM stops the watcher, the folders already started are finished
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    print(f'Watching {watcher.inbox} for new series (settle time: {watcher.settle_time}s)')
+    with watcher:
+        try:
+            return pipeline(watcher=watcher)
+        except KeyboardInterrupt:
+            logging.warning('Interrupted, stopping the watch mode')
+            return []
+
+
+def create_executor(jobs):
+    """
+    Pool of a pipeline stage: `jobs` spawned processes, or a single thread if `jobs` is 1.
+    """
+    if jobs > 1:
+        return ProcessPoolExecutor(max_workers=jobs, mp_context=mp.get_context('spawn'), initializer=init_process)
+    return ThreadPoolExecutor(max_workers=1)
+
+
+def log_failures(failures):
+    logging.error(f'{len(failures)} series failed:')
+    for series, error in failures:
+        logging.error(f'[{series}] {type(error).__name__}: {error}')
+
+
+def init_process():
+    """
+    Configure logging and warnings (main process and pipeline processes)
+    """
+    logging.basicConfig(level=logging.WARNING)
+    coloredlogs.install(fmt='%(message)s', level='WARNING')
+    warnings.filterwarnings("ignore", category=UserWarning, module="pydicom.valuerep")
+
+
+def run_pipeline(dcm_in, dcm_out, min_dcm, label_dict, template_dir, workspace_factory, worker, executors, jobs, index_threads=8,
+                 run_manifest=None, folders=None, run_profile=None, queue_size=2, seg_output='per-label', compact=False,
+                 watcher=None):
+    """
+    Run the conversion, inference and export of every DICOM series of the tree as a staged pipeline: a series is
+    converted while the previous one is in inference and the one before is exported.
+
+    The series are listed once by the series indexer (grouped by SeriesInstanceUID), and every stage uses that
+    manifest instead of listing the folders again.
+    The conversion and export stages run on their own executor (`executors`), with at most `jobs` series each, and the
+    inference stage on the inference `worker` (enough series to fill its batches). At most `queue_size` converted series wait for the inference (so the
+    inference does not wait for the conversion) and the series are only started when there is room in the queues,
+    which bounds the memory and temporary files used.
+    Each series gets its own temporary workspace (created by `workspace_factory`), which is always removed.
+    A failing series is recorded and does not stop the other ones.
+
+    The run manifest of `dcm_out` records the series processed: unchanged leaf folders are skipped before reading any
+    header, unchanged series whose outputs are present are skipped, and series left partial by a previous run are
+    processed again.
+
+    :param executors: (conversion executor, export executor)
+    :param folders: dict {leaf folder: files} to process (default: every leaf folder of `dcm_in`)
+    :param watcher: InboxWatcher: the folders are taken from the watcher as they are complete, until it is stopped\
+                    (`folders` is ignored)
+    :param run_profile: RunProfile receiving the stage profile of each series (None: no profiling)
+    :param queue_size: maximum number of series waiting for each stage
+    :param seg_output: DICOM-SEG output mode, 'per-label' or 'multi' (see `export_series`)
+    :param compact: whether the DICOM-SEG are written with the compact encoding (see `convert_nifti_seg_to_dicom_seg`)
+    :return: list of (series, exception) for the series that failed
+    """
+    if run_manifest is None:
+        run_manifest = RunManifest(dcm_out, labels=label_dict, min_dcm=min_dcm)
+
+    run_profiler = run_profile.profiler if run_profile is not None else NULL_PROFILER
+    prepare_executor, export_executor = executors
+
+    def index_folders(folders):
+        """
+        Series of the leaf folders that are not up to date
+        """
+        with run_profiler.stage('index'):
+            folders = dict(folders)
+            up_to_date = [folder for folder, files in folders.items() if run_manifest.is_folder_done(folder, files)]
+            for folder in up_to_date:
+                del folders[folder]
+            if up_to_date:
+                print(f'{len(up_to_date)} folder(s) are up to date in {run_manifest.path} and were skipped')
+
+            series_list = index_dicom_series(dcm_in, threads=index_threads, folders=folders)
+        series_keys = {folder: [] for folder in folders}
+        for series_info in series_list:
+            series_keys[series_info.folder].append(get_series_key(series_info, dcm_in))
+        for folder, files in folders.items():
+            run_manifest.add_folder(folder, files, series_keys[folder])
+        run_manifest.save()
+        return series_list
+
+    failures = []
+    in_flight = []
+
+    def watch_series():
+        """
+        Series of the folders reported by the watcher (PENDING while no folder is complete)
+        """
+        while True:
+            folders = watcher.get_batch(timeout=1)
+            if folders is None:
+                return
+            if not folders:
+                yield StagedPipeline.PENDING
+                continue
+            yield from start_series(index_folders(folders))
+
+    def start_series(series_list):
+        """
+        Series to process, started only when the pipeline has room for them
+        """
+        for series_info in series_list:
+            key = get_series_key(series_info, dcm_in)
+            fingerprint = run_manifest.fingerprint(series_info.files)
+            if run_manifest.is_series_done(key, fingerprint):
+                print(f'[{key}] Up to date, skipped')
+                continue
+            item = init_series(series_info, dcm_in, dcm_out, min_dcm)
+            if item is None:
+                run_manifest.skip_series(key, fingerprint, 'min_dcm')
+                continue
+            run_manifest.start_series(key, fingerprint, output_folder=item['output_folder'])
+            item.update(key=key, fingerprint=fingerprint)
+            item['profiler'] = StageProfiler() if run_profile is not None else NULL_PROFILER
+            item['workspace'] = workspace_factory()
+            in_flight.append(item)
+            yield item
+
+    def submit_prepare(item):
+        return prepare_executor.submit(call_profiled, item['profiler'].enabled, prepare_series, item['info'],
+                                       item['workspace'], item['series'])
+
+    def submit_inference(item):
+        print(f"[{item['series']}] Starting inference with WMH-SynthSeg")
+        return worker.submit(item['anat_path'], get_temp_dseg_path(item['anat_path']), profiler=item['profiler'])
+
+    def submit_export(item):
+        return export_executor.submit(call_profiled, item['profiler'].enabled, export_series, item['info'],
+                                      item['output_folder'], item['workspace'], item['anat_path'], item['dseg_path'],
+                                      label_dict, template_dir, item['series'], seg_output=seg_output,
+                                      compact=compact)
+
+    def on_result(stage, item, result):
+        if stage != 'inference':
+            # The records of the stages run in the executors come back with their result
+            result, records = result
+            item['profiler'].add(records)
+        if stage == 'prepare':
+            item['anat_path'] = result
+            return result is not None
+        if stage == 'inference':
+            item['dseg_path'] = result
+        else:
+            item['outputs'] = result
+        return True
+
+    def finish_series(item, error):
+        if error is not None:
+            status = 'failed'
+            failures.append((item['series'], error))
+            item['log'].error(f'{type(error).__name__}: {error}')
+        elif item.get('outputs') is None:
+            status = 'skipped'
+            run_manifest.skip_series(item['key'], item['fingerprint'], 'slice mismatch')
+        else:
+            status = 'complete'
+            run_manifest.complete_series(item['key'], item['fingerprint'], item['outputs'])
+        if run_profile is not None:
+            run_profile.save_series(item['series'], item['profiler'], status)
+            if watcher is not None:
+                # The watch mode runs until stopped: the summary is kept up to date
+                run_profile.save_summary()
+        in_flight.remove(item)
+        item['workspace'].cleanup()
+        print(f"[{item['series']}] Temporary folder {item['workspace'].path} was deleted")
+
+    pipeline = StagedPipeline([PipelineStage('prepare', submit_prepare, workers=jobs, max_queued=queue_size),
+                               PipelineStage('inference', submit_inference, workers=worker.capacity,
+                                             max_queued=queue_size),
+                               PipelineStage('export', submit_export, workers=jobs, max_queued=queue_size)],
+                              on_result=on_result, on_finish=finish_series)
+    try:
+        if watcher is not None:
+            pipeline.run(watch_series())
+        else:
+            pipeline.run(start_series(index_folders(scan_leaf_folders(dcm_in) if folders is None else folders)))
+    finally:
+        # Always remove the workspaces of the series still in flight (e.g. on KeyboardInterrupt)
+        for item in in_flight:
+            item['workspace'].cleanup()
+        if run_profile is not None:
+            run_profile.save_summary()
+
+    return failures
+
+
+def get_series_key(series_info, dcm_in):
+    """
+    Key of a series in the run manifest: its folder relative to the input tree and its SeriesInstanceUID
+    """
+    return f'{os.path.relpath(series_info.folder, dcm_in)}/{series_info.uid}'
+
+
+def init_series(series_info, dcm_in, dcm_out, min_dcm):
+    """
+    Check the number of slices of a series and create its output folder.
+
+    :return: series state (dict) or None if the series is skipped
+    """
+    # Init paths
+    folder_basename = os.path.basename(dcm_in)
+    input_folder = os.path.normpath(series_info.folder)
+
+    # Fetch folder structure
+    if os.path.basename(input_folder) != folder_basename:
+        folder_structure = os.path.join(folder_basename, input_folder.split(f'/{folder_basename}/')[-1])
+    else:
+        folder_structure = folder_basename
+
+    # Several series in the same folder are written in a subfolder per series
+    if series_info.shared_folder:
+        folder_structure = os.path.join(folder_structure, series_info.name)
+
+    if min_dcm > series_info.slice_count:
+        logging.warning(f"[{folder_structure}] The dicom series must contain at least {min_dcm} files: {series_info.slice_count} files were detected. If you wish to run the script with fewer files, please use the flag --min-dcm")
+        return None
+
+    # Create output folder if does not exists
+    output_folder = os.path.join(dcm_out, folder_structure)
+    create_directory(output_folder)
+
+    print(f'[{folder_structure}] ================ The series {series_info.name} of {input_folder} has: {series_info.slice_count} .dcm files ({series_info.modality}, {series_info.dim}). ================')
+    print(f'[{folder_structure}] output_folder !: {output_folder}')
+    return {
+        'series': folder_structure,
+        'info': series_info,
+        'output_folder': output_folder,
+        'log': SeriesLogger(logging.getLogger(), folder_structure),
+        'workspace': None,
+        'anat_path': None,
+        'dseg_path': None,
+        'outputs': None,
+    }
+
+
+def prepare_series(series_info, workspace, series, profiler=NULL_PROFILER):
+    """
+    Convert a DICOM series in memory and save it in the workspace if it matches the number of DICOM slices.
+
+    :return: path of the NIfTI image to segment, or None if the series can't be segmented
+    """
+    log = SeriesLogger(logging.getLogger(), series)
+
+    # Convert DICOM to image in memory
+    with profiler.stage('dicom_to_image'):
+        image = convert_dicom_files_to_image(series_info.files)
+
+    # Validation between the number of Dicom images and the anatomical slices.
+    if image.dim[0][2] != series_info.slice_count:
+        log.warning(f'Different number of slices with the original DICOM (possible GRE, DTI, fMRI).')
+        return None
+
+    # Only the images that are segmented are written, uncompressed, for the inference
+    nifti_anat_path = workspace.get_path(series_info.name)
+    with profiler.stage('save_anat'):
+        image.save(nifti_anat_path)
+    workspace.check_quota()
+    return nifti_anat_path
+
+
+def get_temp_dseg_path(nifti_anat_path):
+    """
+    Temporary (uncompressed) segmentation path of an image of the workspace
+    """
+    return f'{os.path.splitext(nifti_anat_path)[0]}_dseg.nii'
+
+
+def export_series(series_info, output_folder, workspace, nifti_anat_path, temp_dseg, label_dict, template_dir, series,
+                  seg_output='per-label', compact=False, profiler=NULL_PROFILER):
+    """
+    Reslice the segmentation to the anatomical image and save it as DICOM segmentation(s).
+
+    :param seg_output: 'per-label': one DICOM-SEG per label present, 'multi': one DICOM-SEG with a segment per label\
+                       present (see `export_multi_segment`)
+    :param compact: whether the DICOM-SEG are cropped and without empty frames (see `convert_nifti_seg_to_dicom_seg`)
+    :return: list of the DICOM segmentation files written
+    """
+    workspace.check_quota()
+
+    # Reslicing of the output (mask) to the anat image (same as mri_vol2vol --regheader --nearest)
+    with profiler.stage('reslice'):
+        image_out_nii = resample_nearest(Image(temp_dseg), Image(nifti_anat_path))
+    if seg_output == 'multi':
+        return export_multi_segment(series_info, output_folder, image_out_nii, label_dict, template_dir, series,
+                                    compact=compact, profiler=profiler)
+
+    output_files = []
+    # Read the source series once for every label
+    dcm_series = None
+    # Split the multiple discrete segmentation (dseg), absent labels are skipped without building a mask
+    for label_name, intensity, mask in split_labels(image_out_nii, label_dict):
+        template_path = os.path.join(template_dir, f'{label_name}.json')
+
+        # Save each class in different files
+        if mask is not None:
+            output_file_path = os.path.join(output_folder, f"{str(intensity).zfill(2)}_{label_name}_WMH_SynthSeg.dcm")
+            if dcm_series is None:
+                with profiler.stage('read_dicom_series'):
+                    dcm_series = DicomSeries(series_info.folder, series_info.uid)
+            with profiler.stage('dicom_seg', label=label_name, intensity=intensity):
+                dcm_seg_file = convert_nifti_seg_to_dicom_seg(dcm_series, mask, template_path, compact=compact)
+                dcm_seg_file.save_as(output_file_path)
+            output_files.append(output_file_path)
+            print(f'[{series}] DICOM segmentation saved on : {output_file_path}')
         else:
-            if min_dcm > file_count:
-                logging.warning(f"The dicom folder must contain at least {min_dcm} files: {file_count} files were detected. If you wish to run the script with fewer files, please use the flag --min-dcm")
+            print(f"[{series}] Label - {intensity} - {label_name} Does Not Exist")
+    return output_files
+
+
+def export_multi_segment(series_info, output_folder, seg_image, label_dict, template_dir, series, compact=False,
+                         profiler=NULL_PROFILER):
+    """
+    Save the labels present in a segmentation as the segments of a single DICOM-SEG, whose template is built from the
+    per-label templates. The labels are renumbered 1, 2, ... (segment numbers) with a lookup table.
+
+    :return: list of the DICOM segmentation file written (empty if no label is present)
+    """
+    with profiler.stage('number_labels'):
+        seg_image, present = number_labels(seg_image, label_dict)
+    present_names = {label_name for label_name, _, _ in present}
+    for label_name, intensity in label_dict.items():
+        if label_name not in present_names:
+            print(f"[{series}] Label - {intensity} - {label_name} Does Not Exist")
+    if not present:
+        return []
+
+    metainfo = build_multi_segment_metainfo([os.path.join(template_dir, f'{label_name}.json')
+                                             for label_name, _, _ in present], description='WMH-SynthSeg')
+    output_file_path = os.path.join(output_folder, MULTI_SEG_NAME)
+    with profiler.stage('read_dicom_series'):
+        dcm_series = DicomSeries(series_info.folder, series_info.uid)
+    with profiler.stage('dicom_seg', label='multi', segments=len(present)):
+        dcm_seg_file = convert_nifti_seg_to_dicom_seg(dcm_series, seg_image, metainfo, compact=compact)
+        dcm_seg_file.save_as(output_file_path)
+    print(f'[{series}] DICOM segmentation ({len(present)} segments) saved on : {output_file_path}')
+    return [output_file_path]
 
 
 if __name__ == "__main__":
-    run_wmh_synthseg()
\ No newline at end of file
+    run_wmh_synthseg()
@@ -1,4 +1,7 @@
 import os
+import mmap
+import weakref
+import itertools
 import numpy as np
 import nibabel as nib
 import logging
@@ -10,8 +13,24 @@ class Image(object):
     """
     Compact version of SCT's Image Class (https://github.com/spinalcordtoolbox/spinalcordtoolbox/blob/master/spinalcordtoolbox/image.py#L245)
     Create an object that behaves similarly to nibabel's image object. Useful additions include: dims, change_orientation and getNonZeroCoordinates.
+
+    Images loaded from a file are decoded lazily: the header, `dim`, `orientation` and `affine` are available without
+    reading the voxels, which are decoded (decompressed for `.nii.gz`) the first time `data` is accessed.
+    `get_region` reads a sub-region without decoding the whole volume.
+
+    The geometry derived from the header (orientation, dimensions and best affine) is cached, and recomputed only
+    when the header changes (including in-place changes such as `hdr.set_sform`).
+
+    `copy` (and `Image(image)`, `deepcopy`) copies the voxels. Internal read-only paths (`save`, `change_orientation`,
+    `change_type`) use copy-on-write copies instead (`copy(share=True)`): the copy shares the voxel buffer of its
+    source, and an image sharing its buffer gets its own copy the first time its `data` is accessed (and so possibly
+    written). Only accesses through `data` are tracked: arrays obtained from `data` before the copy still write to
+    the shared buffer.
     """
 
+    __slots__ = ('affine', '_hdr', '_data', '_dataobj', '_shared', '_path', 'ext', '_geometry', '_geometry_key',
+                 '__weakref__')
+
     def __init__(self, param=None, hdr=None, orientation=None, absolutepath=None, dim=None):
         """
         :param param: string indicating a path to a image file or an `Image` object.
@@ -19,7 +38,12 @@ class Image(object):
 
         # initialization of all parameters
         self.affine = None
-        self.data = None
+        self._data = None
+        self._dataobj = None  # nibabel array proxy of an image loaded from a file and not decoded yet
+        self._shared = None  # _SharedBuffer when the voxel buffer is shared with copies
+        self._hdr = None
+        self._geometry = None  # (orientation, dim, best affine), valid for the header `_geometry_key`
+        self._geometry_key = None
         self._path = None
         self.ext = ""
 
@@ -48,13 +72,83 @@ class Image(object):
         # Fix any mismatch between the array's datatype and the header datatype
         self.fix_header_dtype()
 
+    @property
+    def data(self):
+        array = self._array()
+        if self._shared is not None:
+            # Copy-on-write: the buffer is copied only if other images still use it
+            if len(self._shared.owners) > 1:
+                self._data = array.copy(order='K')  # same memory layout as the shared buffer
+            self._leave_shared()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._leave_shared()
+        self._data = value
+        self._dataobj = None
+
+    def _array(self):
+        """
+        Voxel array, decoded if needed, without un-sharing it: internal read-only access, it must not be written.
+        """
+        if self._dataobj is not None:
+            self._data = np.asanyarray(self._dataobj)
+            self._dataobj = None
+        return self._data
+
+    def _share_view(self, array, source):
+        """
+        Set the data to `array`, a view of the buffer of `source`, keeping the buffer shared (copy-on-write).
+        """
+        if source is not self and source._shared is None:
+            source._shared = _SharedBuffer(source)
+        holder = source._shared
+        if holder is not self._shared:
+            self._leave_shared()
+            if holder is not None:
+                holder.owners.add(self)
+                self._shared = holder
+        self._data = array
+        self._dataobj = None
+
+    def _leave_shared(self):
+        if self._shared is not None:
+            self._shared.owners.discard(self)
+            self._shared = None
+
+    @property
+    def is_loaded(self):
+        """
+        Whether the voxels are in memory (False if they are still to be read from the file)
+        """
+        return self._dataobj is None
+
     @property
     def dim(self):
-        return get_dimension(self)
-    
+        return self._get_geometry()[1]
+
     @property
     def orientation(self):
-        return get_orientation(self)
+        return self._get_geometry()[0]
+
+    @property
+    def best_affine(self):
+        """
+        Affine of the header (sform or qform, see `nibabel.Nifti1Header.get_best_affine`), read-only
+        """
+        return self._get_geometry()[2]
+
+    def _get_geometry(self):
+        # The binary block of the header changes with any header update, so it is used as the cache key
+        key = self._hdr.binaryblock
+        if self._geometry is None or key != self._geometry_key:
+            affine = self._hdr.get_best_affine()
+            affine.flags.writeable = False
+            orientation = orientation_string_nib2sct("".join(nib.orientations.aff2axcodes(affine)))
+            self._geometry = (orientation, get_dimension(self), affine)
+            self._geometry_key = key
+        return self._geometry
     
     @property
     def absolutepath(self):
@@ -85,6 +179,15 @@ class Image(object):
             value = os.path.abspath(value)
         self._path = value
     
+    @property
+    def hdr(self):
+        return self._hdr
+
+    @hdr.setter
+    def hdr(self, value):
+        self._hdr = value
+        self._geometry = None
+
     @property
     def header(self):
         return self.hdr
@@ -94,14 +197,33 @@ class Image(object):
         self.hdr = value
 
     def __deepcopy__(self, memo):
-        return type(self)(deepcopy(self.data, memo), deepcopy(self.hdr, memo), deepcopy(self.orientation, memo), deepcopy(self.absolutepath, memo), deepcopy(self.dim, memo))
+        return type(self)(self)
 
-    def copy(self, image=None):
+    def copy(self, image=None, share=False):
+        """
+        Copy `image` into this image, or return a copy of this image.
+
+        :param share: if True, the voxel buffer is shared until one of the images accesses its `data` (copy-on-write).\
+                      For internal read-only uses: writes through arrays obtained from `data` are not tracked.
+        """
         if image is not None:
             self.affine = deepcopy(image.affine)
-            self.data = deepcopy(image.data)
+            if not image.is_loaded:
+                # The array proxy is read-only: the copy is decoded from the file on its own first access
+                self._leave_shared()
+                self._data = None
+                self._dataobj = image._dataobj
+            elif share:
+                self._share_view(image._data, image)
+            else:
+                self.data = image._data.copy(order='K')  # same memory layout as the source
             self.hdr = deepcopy(image.hdr)
             self._path = deepcopy(image._path)
+        elif share:
+            # The array given to the constructor is replaced by the shared one, it is not copied
+            im = type(self)(self._array(), hdr=self.hdr)
+            im.copy(self, share=True)
+            return im
         else:
             return deepcopy(self)
 
@@ -116,14 +238,32 @@ class Image(object):
         self.absolutepath = os.path.abspath(path)
         im_file = nib.load(self.absolutepath, mmap=True)
         self.affine = im_file.affine.copy()
-        self.data = np.asanyarray(im_file.dataobj)
         self.hdr = im_file.header.copy()
+        dataobj = im_file.dataobj
+        if getattr(dataobj, 'slope', 1.0) == 1.0 and getattr(dataobj, 'inter', 0.0) == 0.0:
+            # Voxels are decoded on the first access to `data`
+            self._dataobj = dataobj
+        else:
+            # The data type of scaled data (scl_slope/scl_inter) is only known once decoded
+            self.data = np.asanyarray(dataobj)
         if path != self.absolutepath:
-            logger.debug("Loaded %s (%s) orientation %s shape %s", path, self.absolutepath, self.orientation, self.data.shape)
+            logger.debug("Loaded %s (%s) orientation %s shape %s", path, self.absolutepath, self.orientation, self.hdr.get_data_shape())
         else:
-            logger.debug("Loaded %s orientation %s shape %s", path, self.orientation, self.data.shape)
+            logger.debug("Loaded %s orientation %s shape %s", path, self.orientation, self.hdr.get_data_shape())
 
-    def change_orientation(self, orientation, inverse=False):
+    def get_region(self, region):
+        """
+        Read a sub-region of the image. If the voxels are not decoded yet, only the region is read from the file
+        (e.g. a few slices of a large `.nii.gz` image) and the image stays lazy.
+
+        :param region: index or tuple of slices, as used to index `data`
+        :return: numpy array
+        """
+        if self._dataobj is not None:
+            return np.asanyarray(self._dataobj[region])
+        return self._array()[region].copy() if self._shared is not None else self._data[region]
+
+    def change_orientation(self, orientation, inverse=False, order=None, out=None):
         """
         Change orientation on image (in-place).
 
@@ -132,54 +272,72 @@ class Image(object):
         :param inverse: if you think backwards, use this to specify that you actually\
                         want to transform *from* the specified orientation, not *to*\
                         it.
+        :param order: memory layout of the data, see `change_orientation`
+        :param out: preallocated array receiving the data, see `change_orientation`
 
         """
-        change_orientation(self, orientation, self, inverse=inverse)
+        change_orientation(self, orientation, self, inverse=inverse, order=order, out=out)
         return self
     
-    def getNonZeroCoordinates(self, sorting=None, reverse_coord=False):
+    def getNonZeroCoordinates(self, sorting=None, reverse_coord=False, as_list=False):
         """
         This function return all the non-zero coordinates that the image contains.
         Coordinate list can also be sorted by x, y, z, or the value with the parameter sorting='x', sorting='y', sorting='z' or sorting='value'
         If reverse_coord is True, coordinate are sorted from larger to smaller.
+        Sorting is stable: coordinates with the same key keep the (x, y, z) order, as with `sorted`.
 
         Removed Coordinate object
+
+        :param as_list: if True, return the former list of [x, y, z, value] lists instead of an array
+        :return: structured array with the fields 'x', 'y', 'z' (0 for 2D images) and 'value', one element per\
+                 non-zero voxel
         """
-        n_dim = 1
-        if self.dim[3] == 1:
-            n_dim = 3
-        else:
-            n_dim = 4
-        if self.dim[2] == 1:
-            n_dim = 2
-
-        if n_dim == 3:
-            X, Y, Z = (self.data > 0).nonzero()
-            list_coordinates = [[X[i], Y[i], Z[i], self.data[X[i], Y[i], Z[i]]] for i in range(0, len(X))]
-        elif n_dim == 2:
-            try:
-                X, Y = (self.data > 0).nonzero()
-                list_coordinates = [[X[i], Y[i], 0, self.data[X[i], Y[i]]] for i in range(0, len(X))]
-            except ValueError:
-                X, Y, Z = (self.data > 0).nonzero()
-                list_coordinates = [[X[i], Y[i], 0, self.data[X[i], Y[i], 0]] for i in range(0, len(X))]
-
-        if sorting is not None:
-            if reverse_coord not in [True, False]:
-                raise ValueError('reverse_coord parameter must be a boolean')
-
-            if sorting == 'x':
-                list_coordinates = sorted(list_coordinates, key=lambda el: el[0], reverse=reverse_coord)
-            elif sorting == 'y':
-                list_coordinates = sorted(list_coordinates, key=lambda el: el[1], reverse=reverse_coord)
-            elif sorting == 'z':
-                list_coordinates = sorted(list_coordinates, key=lambda el: el[2], reverse=reverse_coord)
-            elif sorting == 'value':
-                list_coordinates = sorted(list_coordinates, key=lambda el: el[3], reverse=reverse_coord)
+        if self.dim[0][3] != 1:
+            raise ValueError("getNonZeroCoordinates only supports 2D and 3D images")
+        if sorting not in (None, 'x', 'y', 'z', 'value'):
+            raise ValueError("sorting parameter must be either 'x', 'y', 'z' or 'value'")
+        if reverse_coord not in [True, False]:
+            raise ValueError('reverse_coord parameter must be a boolean')
+
+        data = self._array()
+        if data.ndim == 2:
+            data = data[:, :, None]
+        elif data.ndim > 3:
+            data = data.reshape(data.shape[:3])
+
+        # Non-zero voxels are listed in C order, so moving the sorting axis first (flipped to sort from larger to
+        # smaller) gives the stable sort by this coordinate without sorting
+        fields = ['x', 'y', 'z']
+        axis = fields.index(sorting) if sorting in fields else None
+        if axis is not None:
+            if reverse_coord:
+                data = np.flip(data, axis)
+            data = np.moveaxis(data, axis, 0)
+            fields = [fields[axis]] + fields[:axis] + fields[axis + 1:]
+        data = np.ascontiguousarray(data)
+
+        flat = data.reshape(-1)
+        indices = np.flatnonzero(flat > 0)
+        values = flat[indices]
+        if sorting == 'value':
+            if reverse_coord:
+                # Descending order keeping the original order of equal values (same as `sorted(..., reverse=True)`)
+                order = len(values) - 1 - np.argsort(values[::-1], kind='stable')[::-1]
             else:
-                raise ValueError("sorting parameter must be either 'x', 'y', 'z' or 'value'")
-
-        return list_coordinates
+                order = np.argsort(values, kind='stable')
+            indices = indices[order]
+            values = values[order]
+
+        coordinates = np.empty(len(indices), dtype=[('x', np.intp), ('y', np.intp), ('z', np.intp), ('value', data.dtype)])
+        coordinates['value'] = values
+        quotient = np.divmod(indices, data.shape[2], out=(indices, coordinates[fields[2]]))[0]
+        np.divmod(quotient, data.shape[1], out=(coordinates[fields[0]], coordinates[fields[1]]))
+        if axis is not None and reverse_coord:
+            np.subtract(data.shape[0] - 1, coordinates[sorting], out=coordinates[sorting])
+
+        if as_list:
+            return [list(coordinate) for coordinate in coordinates.tolist()]
+        return coordinates
     
     def change_type(self, dtype):
         """
@@ -196,7 +354,7 @@ class Image(object):
         """
         # Using bool for nibabel headers is unsupported, so use uint8 instead:
         # `nibabel.spatialimages.HeaderDataError: data dtype "bool" not supported`
-        dtype_data = self.data.dtype
+        dtype_data = self._data.dtype if self._dataobj is None else self._dataobj.dtype
         if dtype_data == bool:
             dtype_data = np.uint8
 
@@ -258,10 +416,10 @@ class Image(object):
                 logger.warning("File %s already exists. Will overwrite it.", path)
             if os.path.isabs(path):
                 logger.debug("Saving image to %s orientation %s shape %s",
-                             path, self.orientation, self.data.shape)
+                             path, self.orientation, self._array().shape)
             else:
                 logger.debug("Saving image to %s (%s) orientation %s shape %s",
-                             path, os.path.abspath(path), self.orientation, self.data.shape)
+                             path, os.path.abspath(path), self.orientation, self._array().shape)
 
             # Now that `path` has been set and log messages have been written, we can assign it to the image itself
             self.absolutepath = os.path.abspath(path)
@@ -270,11 +428,14 @@ class Image(object):
                 self.change_type(dtype)
 
             if self.hdr is not None:
-                self.hdr.set_data_shape(self.data.shape)
+                self.hdr.set_data_shape(self._array().shape)
                 self.fix_header_dtype()
 
-            # nb. that copy() is important because if it were a memory map, save() would corrupt it
-            dataobj = self.data.copy()
+            # nb. a memory map is copied because nibabel could corrupt it (e.g. when overwriting the mapped file),
+            # other arrays are only read by nibabel
+            dataobj = self._array()
+            if is_memmap(dataobj):
+                dataobj = dataobj.copy()
             affine = None
             header = self.hdr.copy() if self.hdr is not None else None
             nib.save(nib.nifti1.Nifti1Image(dataobj, affine, header), self.absolutepath)
@@ -282,10 +443,33 @@ class Image(object):
                 raise RuntimeError(f"Couldn't save image to {self.absolutepath}")
         else:
             # if we're not operating in-place, then make any required modifications on a throw-away copy
-            self.copy().save(path, dtype, verbose, mutable=True)
+            # (copy-on-write: the voxel buffer is not copied)
+            self.copy(share=True).save(path, dtype, verbose, mutable=True)
         return self
 
 
+class _SharedBuffer(object):
+    """
+    Voxel buffer shared by copy-on-write copies of an image: `owners` are the images still using it.
+    """
+
+    __slots__ = ('owners',)
+
+    def __init__(self, image):
+        self.owners = weakref.WeakSet([image])
+
+
+def is_memmap(array):
+    """
+    Whether an array is backed by a memory-mapped file (np.memmap or mmap), directly or through a view.
+    """
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
 class SlicerOneAxis(object):
     """
     Image slicer to use when you don't care about the 2D slice orientation,
@@ -320,10 +504,11 @@ class SlicerOneAxis(object):
         # SCT convention
         from_dir = im.orientation[dim_nr]
         self.direction = +1 if axis[0] == from_dir else -1
-        self.nb_slices = im.dim[dim_nr]
+        self.nb_slices = im.dim[0][dim_nr]
         self.im = im
         self.axis = axis
-        self._slice = lambda idx: tuple([(idx if x in axis else slice(None)) for x in im.orientation])
+        orientation = im.orientation
+        self._slice = lambda idx: tuple([(idx if x in axis else slice(None)) for x in orientation])
 
     def __len__(self):
         return self.nb_slices
@@ -367,16 +552,23 @@ def get_dimension(im_file, verbose=1):
     return tuple(ndims) , tuple(pdims)
 
 
-def change_orientation(im_src, orientation, im_dst=None, inverse=False):
+def change_orientation(im_src, orientation, im_dst=None, inverse=False, order=None, out=None):
     """
     Copied from https://github.com/spinalcordtoolbox/spinalcordtoolbox/
 
+    The change is a single `np.transpose` of a flipped view, taken from the precomputed `ORIENTATION_TRANSFORMS`.
+    Dimensions after the third one (time, vector components) are kept as they are.
+
     :param im_src: source image
     :param orientation: orientation string (SCT "from" convention)
     :param im_dst: destination image (can be the source image for in-place
                    operation, can be unset to generate one)
     :param inverse: if you think backwards, use this to specify that you actually
                     want to transform *from* the specified orientation, not *to* it.
+    :param order: None: the data is a strided view of the source buffer (copy-on-write, no copy),
+                  'C' or 'F': the data is copied to a contiguous array with this memory layout
+                  (e.g. 'C' before `sitk.GetImageFromArray`, 'F' before saving a NIfTI file)
+    :param out: preallocated array of the destination shape receiving the data (takes precedence over `order`)
     :return: an image with changed orientation
 
     .. note::
@@ -384,13 +576,14 @@ def change_orientation(im_src, orientation, im_dst=None, inverse=False):
         - if the source image is < 3D, it is reshaped to 3D and the destination is 3D
     """
 
-    if len(im_src.data.shape) < 3:
+    ndim = im_src._array().ndim
+    if ndim < 3:
         pass  # Will reshape to 3D
-    elif len(im_src.data.shape) == 3:
+    elif ndim == 3:
         pass  # OK, standard 3D volume
-    elif len(im_src.data.shape) == 4:
+    elif ndim == 4:
         pass  # OK, standard 4D volume
-    elif len(im_src.data.shape) == 5 and im_src.header.get_intent()[0] == "vector":
+    elif ndim == 5 and im_src.header.get_intent()[0] == "vector":
         pass  # OK, physical displacement field
     else:
         raise NotImplementedError("Don't know how to change orientation for this image")
@@ -400,52 +593,43 @@ def change_orientation(im_src, orientation, im_dst=None, inverse=False):
     if inverse:
         im_src_orientation, im_dst_orientation = im_dst_orientation, im_src_orientation
 
-    perm, inversion = _get_permutations(im_src_orientation, im_dst_orientation)
+    try:
+        axes, flips, ornt = ORIENTATION_TRANSFORMS[im_src_orientation, im_dst_orientation]
+    except KeyError:
+        raise ValueError(f"Invalid orientation change: {im_src_orientation} -> {im_dst_orientation}")
 
     if im_dst is None:
-        im_dst = im_src.copy()
+        im_dst = im_src.copy(share=True)
         im_dst._path = None
 
-    im_src_data = im_src.data
+    im_src_data = im_src._array()
     if len(im_src_data.shape) < 3:
         im_src_data = im_src_data.reshape(tuple(list(im_src_data.shape) + ([1] * (3 - len(im_src_data.shape)))))
 
-    # Update data by performing inversions and swaps
-
-    # axes inversion (flip)
-    data = im_src_data[::inversion[0], ::inversion[1], ::inversion[2]]
-
-    # axes manipulations (transpose)
-    if perm == [1, 0, 2]:
-        data = np.swapaxes(data, 0, 1)
-    elif perm == [2, 1, 0]:
-        data = np.swapaxes(data, 0, 2)
-    elif perm == [0, 2, 1]:
-        data = np.swapaxes(data, 1, 2)
-    elif perm == [2, 0, 1]:
-        data = np.swapaxes(data, 0, 2)  # transform [2, 0, 1] to [1, 0, 2]
-        data = np.swapaxes(data, 0, 1)  # transform [1, 0, 2] to [0, 1, 2]
-    elif perm == [1, 2, 0]:
-        data = np.swapaxes(data, 0, 2)  # transform [1, 2, 0] to [0, 2, 1]
-        data = np.swapaxes(data, 1, 2)  # transform [0, 2, 1] to [0, 1, 2]
-    elif perm == [0, 1, 2]:
-        # do nothing
-        pass
-    else:
-        raise NotImplementedError()
+    # Update data: axes inversion (flip) and manipulations (transpose), as one view
+    extra_axes = tuple(range(3, im_src_data.ndim))
+    data = np.transpose(im_src_data[flips], axes + extra_axes)
 
     # Update header
 
-    im_src_aff = im_src.hdr.get_best_affine()
-    aff = nib.orientations.inv_ornt_aff(
-        np.array((perm, inversion)).T,
-        im_src_data.shape)
+    im_src_aff = im_src.best_affine
+    aff = nib.orientations.inv_ornt_aff(ornt, im_src_data.shape)
     im_dst_aff = np.matmul(im_src_aff, aff)
 
     im_dst.header.set_qform(im_dst_aff)
     im_dst.header.set_sform(im_dst_aff)
     im_dst.header.set_data_shape(data.shape)
-    im_dst.data = data
+
+    if out is not None:
+        if out.shape != data.shape:
+            raise ValueError(f"Output array shape {out.shape} does not match the image shape {data.shape}")
+        np.copyto(out, data, casting='same_kind')
+        im_dst.data = out
+    elif order is not None and not data.flags[f'{order}_CONTIGUOUS']:
+        im_dst.data = np.array(data, order=order)
+    else:
+        # `data` is a view of the source buffer, which stays shared (copy-on-write) with the source
+        im_dst._share_view(data, im_src)
 
     return im_dst
 
@@ -473,6 +657,30 @@ def _get_permutations(im_src_orientation, im_dst_orientation):
     return perm, inversion
 
 
+def _get_orientation_transforms():
+    """
+    Transforms between all the pairs of the 48 orientations (SCT "from" convention).
+
+    :return: dict {(source orientation, destination orientation): (axes, flips, ornt)} where the destination data is
+             `np.transpose(data[flips], axes)` and `ornt` is the nibabel orientation used to update the affine
+    """
+    orientations = [''.join(letters)
+                    for axes in itertools.permutations(('LR', 'PA', 'IS'))
+                    for letters in itertools.product(*axes)]
+    transforms = {}
+    for src in orientations:
+        for dst in orientations:
+            perm, inversion = _get_permutations(src, dst)
+            # Destination axis perm[i] is source axis i
+            axes = tuple(int(i) for i in np.argsort(perm))
+            flips = tuple(slice(None, None, step) for step in inversion)
+            transforms[src, dst] = (axes, flips, np.array((perm, inversion)).T)
+    return transforms
+
+
+ORIENTATION_TRANSFORMS = _get_orientation_transforms()
+
+
 def get_orientation(im):
     """
     Copied from https://github.com/spinalcordtoolbox/spinalcordtoolbox/
@@ -480,7 +688,9 @@ def get_orientation(im):
     :param im: an Image
     :return: reference space string (ie. what's in Image.orientation)
     """
-    res = "".join(nib.orientations.aff2axcodes(im.hdr.get_best_affine()))
+    if isinstance(im, Image):
+        return im.orientation
+    res = "".join(nib.orientations.aff2axcodes(im.header.get_best_affine()))
     return orientation_string_nib2sct(res)
 
 
@@ -521,33 +731,26 @@ def change_type(im_src, dtype, im_dst=None):
     """
 
     if im_dst is None:
-        im_dst = im_src.copy()
+        im_dst = im_src.copy(share=True)
         im_dst._path = None
 
     if dtype is None:
         return im_dst
 
-    # get min/max from input image
-    min_in = np.nanmin(im_src.data)
-    max_in = np.nanmax(im_src.data)
+    # get min/max from input image, and check if voxel values are real or integer (for 'minimize'), in one pass
+    min_in, max_in, isInteger = get_value_range(im_src._array(), check_integer=(dtype == 'minimize'))
 
     # find optimum type for the input image
     if dtype in ('minimize', 'minimize_int'):
         # warning: does not take intensity resolution into account, neither complex voxels
-
-        # check if voxel values are real or integer
-        isInteger = True
-        if dtype == 'minimize':
-            for vox in im_src.data.flatten():
-                if int(vox) != vox:
-                    isInteger = False
-                    break
+        if dtype == 'minimize_int':
+            isInteger = True
 
         if isInteger:
             if min_in >= 0:  # unsigned
                 if max_in <= np.iinfo(np.uint8).max:
                     dtype = np.uint8
-                elif max_in <= np.iinfo(np.uint16):
+                elif max_in <= np.iinfo(np.uint16).max:
                     dtype = np.uint16
                 elif max_in <= np.iinfo(np.uint32).max:
                     dtype = np.uint32
@@ -571,7 +774,8 @@ def change_type(im_src, dtype, im_dst=None):
             #    type = 'np.float16' # not supported by nibabel
             if max_in <= np.finfo(np.float32).max and min_in >= np.finfo(np.float32).min:
                 dtype = np.float32
-            elif max_in <= np.finfo(np.float64).max and min_in >= np.finfo(np.float64).min:
+            else:
+                # Includes infinite values
                 dtype = np.float64
 
         dtype = to_dtype(dtype)
@@ -589,15 +793,55 @@ def change_type(im_src, dtype, im_dst=None):
                 # This condition is important for binary images since we do not want to scale them
                 logger.warning(f"To avoid intensity overflow due to convertion to +{dtype.name}+, intensity will be rescaled to the maximum quantization scale")
                 # rescale intensity
-                data_rescaled = im_src.data * (max_out - min_out) / (max_in - min_in)
+                data_rescaled = im_src._array() * (max_out - min_out) / (max_in - min_in)
                 im_dst.data = data_rescaled - (data_rescaled.min() - min_out)
 
     # change type of data in both numpy array and nifti header
-    im_dst.data = getattr(np, dtype.name)(im_dst.data)
+    # A shared buffer is not copied before the conversion, which creates a new array (if the type changes)
+    if im_dst._array().dtype != dtype:
+        im_dst.data = getattr(np, dtype.name)(im_dst._array())
     im_dst.hdr.set_data_dtype(dtype)
     return im_dst
 
 
+def get_value_range(data, check_integer=False, chunk_size=2 ** 22):
+    """
+    Min and max of an array (NaN are ignored, as with np.nanmin/np.nanmax) and whether all its values are integers,
+    computed in one pass over blocks of about `chunk_size` values (no copy of the whole array, even for views).
+
+    :param data: numpy array
+    :param check_integer: if True, check whether all the values are integers (always True for integer types).\
+                          Non-finite values (NaN, inf) are not integers.
+    :param chunk_size: approximate number of values processed at once
+    :return: min, max, is_integer (None if not checked)
+    """
+    data = np.asanyarray(data)
+    if data.ndim == 0:
+        data = data.reshape(1)
+    if data.size == 0:
+        raise ValueError("Cannot compute the value range of an empty array")
+    is_float = not np.issubdtype(data.dtype, np.integer) and data.dtype != bool
+    # Integer types need no check, float values are checked block by block until a non-integer is found
+    is_integer = True if check_integer else None
+
+    min_in = max_in = None
+    rows = max(1, chunk_size // max(1, data[0].size))
+    with np.errstate(invalid='ignore'):
+        for i in range(0, data.shape[0], rows):
+            block = data[i:i + rows]
+            if is_float:
+                # fmin/fmax ignore NaN without copying the block
+                block_min, block_max = np.fmin.reduce(block, axis=None), np.fmax.reduce(block, axis=None)
+                if is_integer:
+                    # x - trunc(x) is 0 for integers, non-zero for decimals and NaN for non-finite values
+                    is_integer = not np.any(block - np.trunc(block))
+            else:
+                block_min, block_max = block.min(), block.max()
+            min_in = block_min if min_in is None else np.fmin(min_in, block_min)
+            max_in = block_max if max_in is None else np.fmax(max_in, block_max)
+    return min_in, max_in, is_integer
+
+
 def to_dtype(dtype):
     """
     Take a dtypeification and return an np.dtype
@@ -634,7 +878,7 @@ def zeros_like(img, dtype=None):
 
     Copied from https://github.com/spinalcordtoolbox/spinalcordtoolbox/image.py
     """
-    zimg = Image(np.zeros_like(img.data), hdr=img.hdr.copy())
+    zimg = Image(np.zeros_like(img._array()), hdr=img.hdr.copy())
     if dtype is not None:
         zimg.change_type(dtype)
     return zimg
@@ -656,30 +900,182 @@ def empty_like(img, dtype=None):
     return dst
 
 
-def find_zmin_zmax(im, threshold=0.1):
+def resample_nearest(im_src, im_ref, chunk_size=2 ** 22):
+    """
+    Reslice an image onto the voxel grid of a reference image with nearest-neighbour interpolation, using the
+    affines of both images. Same result as FreeSurfer's `mri_vol2vol --mov im_src --targ im_ref --regheader --nearest`:
+    voxel coordinates are rounded with `nint` (half away from zero) and voxels falling outside the source are 0.
+
+    The reference grid is processed in slabs along its last axis of about `chunk_size` voxels, so the temporary
+    coordinate arrays stay bounded whatever the volume size.
+
+    :param im_src: Image to reslice (3D, or 4D with the extra dimension kept as is)
+    :param im_ref: Image defining the output grid (only its header is used)
+    :param chunk_size: approximate number of voxels processed at once
+    :return: Image on the grid of `im_ref` with the data type of `im_src`
+    """
+    src = im_src._array()
+    src_shape = np.array(src.shape[:3])
+    ref_shape = tuple(im_ref.hdr.get_data_shape()[:3])
+    ref_shape = ref_shape + (1,) * (3 - len(ref_shape))
+
+    # Transformation from reference voxel to source voxel coordinates
+    vox2vox = np.linalg.inv(im_src.best_affine) @ im_ref.best_affine
+
+    out = np.zeros(ref_shape + src.shape[3:], dtype=src.dtype)
+    i = np.arange(ref_shape[0], dtype=np.float64)[:, None, None]
+    j = np.arange(ref_shape[1], dtype=np.float64)[None, :, None]
+    step = max(1, chunk_size // (ref_shape[0] * ref_shape[1]))
+    for k0 in range(0, ref_shape[2], step):
+        k = np.arange(k0, min(k0 + step, ref_shape[2]), dtype=np.float64)[None, None, :]
+        valid = None
+        indices = []
+        for axis in range(3):
+            coord = vox2vox[axis, 0] * i + vox2vox[axis, 1] * j + vox2vox[axis, 2] * k + vox2vox[axis, 3]
+            # nint: round half away from zero
+            index = np.where(coord >= 0, np.floor(coord + 0.5), np.ceil(coord - 0.5)).astype(np.intp)
+            inside = (index >= 0) & (index < src_shape[axis])
+            valid = inside if valid is None else valid & inside
+            indices.append(index)
+        out_slab = out[:, :, k0:k0 + k.shape[2]]
+        out_slab[valid] = src[indices[0][valid], indices[1][valid], indices[2][valid]]
+
+    hdr = im_ref.hdr.copy()
+    hdr.set_data_dtype(out.dtype)
+    hdr.set_slope_inter(None, None)
+    return Image(out, hdr=hdr)
+
+
+def split_labels(im, labels):
+    """
+    Split a discrete segmentation into one binary mask per label.
+
+    The segmentation is cast to uint8 and histogrammed once (`np.bincount`) to find the labels that are present.
+    Absent labels are skipped before any mask is built, and the masks of the present labels are computed lazily,
+    one at a time, in a single reused buffer. The intensity 0 is the background and is never a label (as in
+    `number_labels`).
+
+    :param im: Image of the discrete segmentation
+    :param labels: dict {label_name: intensity}
+    :return: generator of (label_name, intensity, mask), where mask is a uint8 Image (0/1) or None if the label\
+             is absent (or 0). The mask data is overwritten at the next iteration: copy it (`mask.copy()`) if it must be kept.
+    """
+    data = im._array()
+    if data.dtype != np.uint8:
+        data = data.astype(np.uint8)
+    counts = np.bincount(data.ravel(), minlength=np.iinfo(np.uint8).max + 1)
+
+    hdr = im.hdr.copy()
+    hdr.set_data_dtype(np.uint8)
+    buffer = None
+    for label_name, intensity in labels.items():
+        if not 0 < intensity < len(counts) or counts[intensity] == 0:
+            yield label_name, intensity, None
+            continue
+        if buffer is None:
+            buffer = np.empty(data.shape, dtype=np.uint8)
+        np.equal(data, intensity, out=buffer.view(bool))
+        yield label_name, intensity, Image(buffer, hdr=hdr)
+
+
+def number_labels(im, labels):
+    """
+    Renumber the labels of a discrete segmentation present in `labels` as 1, 2, ... (in the order of `labels`, absent
+    labels are skipped) with a single lookup table pass, e.g. for the segment numbers of a multi-segment DICOM-SEG.
+    Values that are not in `labels` become 0.
+
+    :param im: Image of the discrete segmentation
+    :param labels: dict {label_name: intensity}
+    :return: uint8 Image of the renumbered segmentation and list of (label_name, intensity, number) of the labels\
+             present
+    """
+    data = im._array()
+    if data.dtype != np.uint8:
+        data = data.astype(np.uint8)
+    counts = np.bincount(data.ravel(), minlength=np.iinfo(np.uint8).max + 1)
+
+    lut = np.zeros(len(counts), dtype=np.uint8)
+    present = []
+    for label_name, intensity in labels.items():
+        if 0 < intensity < len(counts) and counts[intensity] > 0:
+            present.append((label_name, intensity, len(present) + 1))
+            lut[intensity] = len(present)
+
+    hdr = im.hdr.copy()
+    hdr.set_data_dtype(np.uint8)
+    return Image(lut[data], hdr=hdr), present
+
+
+def find_zmin_zmax(im, threshold=0.1, return_bbox=False):
     """
     Find the min (and max) z-slice index below which (and above which) slices only have voxels below a given threshold.
 
+    The slice indices are counted along the inferior-superior axis, from the most inferior slice, whatever the
+    orientation of the image. They come from a single vectorized pass over the volume (see `get_bounding_box`).
+    zmax is the last slice with voxels above the threshold (a single slice gives zmin == zmax).
+
     :param im: Image object
     :param threshold: threshold to apply before looking for zmin/zmax, typically corresponding to noise level.
-    :return: [zmin, zmax]
+    :param return_bbox: if True, also return the bounding box of `get_bounding_box` (in array indices)
+    :return: [zmin, zmax] (or [zmin, zmax, bbox]). The full range is returned for an empty image.
 
     Copied from https://github.com/spinalcordtoolbox/spinalcordtoolbox/image.py
     """
-    slicer = SlicerOneAxis(im, axis="IS")
+    bbox = get_bounding_box(im, threshold=threshold)
+
+    # Inferior-superior axis of the array, as used by SlicerOneAxis(im, axis="IS")
+    orientation = im.orientation
+    axis = orientation.find('I') if 'I' in orientation else orientation.find('S')
+    nb_slices = im.dim[0][axis]
 
     # Make sure image is not empty
-    if not np.any(slicer):
+    if bbox is None:
         logger.error('Input image is empty')
+        zmin, zmax = 0, nb_slices - 1
+    else:
+        zmin, zmax = bbox[axis]
+        if orientation[axis] == 'S':
+            # Array indices go from superior to inferior
+            zmin, zmax = nb_slices - 1 - zmax, nb_slices - 1 - zmin
 
-    # Iterate from bottom to top until we find data
-    for zmin in range(0, len(slicer)):
-        if np.any(slicer[zmin] > threshold):
-            break
+    if return_bbox:
+        return zmin, zmax, bbox
+    return zmin, zmax
 
-    # Conversely from top to bottom
-    for zmax in range(len(slicer) - 1, zmin, -1):
-        if np.any(slicer[zmax] > threshold):
-            break
 
-    return zmin, zmax
\ No newline at end of file
+def get_bounding_box(im, threshold=0.1, chunk_size=2 ** 22):
+    """
+    Bounding box of the voxels above a threshold, computed in one pass over slabs of about `chunk_size` voxels along
+    the first axis (the thresholded volume is never held in memory as a whole).
+
+    :param im: Image object (2D images are handled as 3D with one slice, extra dimensions are merged)
+    :param threshold: voxels strictly above the threshold are kept
+    :param chunk_size: approximate number of voxels processed at once
+    :return: ((xmin, xmax), (ymin, ymax), (zmin, zmax)) in array indices (inclusive), or None if no voxel is above\
+             the threshold
+    """
+    data = im._array()
+    if data.ndim < 3:
+        data = data.reshape(data.shape + (1,) * (3 - data.ndim))
+
+    nx, ny, nz = data.shape[:3]
+    profile_x = np.zeros(nx, dtype=bool)
+    plane_yz = np.zeros((ny, nz), dtype=bool)
+    other_axes = tuple(range(3, data.ndim))
+    step = max(1, chunk_size // max(1, data[0].size))
+    for i in range(0, nx, step):
+        mask = data[i:i + step] > threshold
+        if other_axes:
+            mask = mask.any(axis=other_axes)
+        plane = mask.any(axis=0)
+        plane_yz |= plane
+        profile_x[i:i + step] = mask.any(axis=(1, 2))
+
+    profiles = (profile_x, plane_yz.any(axis=1), plane_yz.any(axis=0))
+    if not profile_x.any():
+        return None
+    bbox = []
+    for profile in profiles:
+        indices = np.flatnonzero(profile)
+        bbox.append((int(indices[0]), int(indices[-1])))
+    return tuple(bbox)
@@ -0,0 +1,156 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+import importlib.metadata
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'psb_manifest.json'
+
+
+def get_tool_version():
+    try:
+        return importlib.metadata.version('psb')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def fingerprint_files(files, extra=()):
+    """
+    Fingerprint of a list of files from their path, size and modification time (the files are not read).
+
+    :param files: list of file paths
+    :param extra: other values to include in the fingerprint (e.g. tool version)
+    :return: hexadecimal sha256
+    """
+    h = hashlib.sha256()
+    for value in extra:
+        h.update(f'{value}\n'.encode())
+    for file in sorted(files):
+        st = os.stat(file)
+        h.update(f'{file}\t{st.st_size}\t{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+
+class RunManifest(object):
+    """
+    Record, stored in the output folder, of the series already processed by previous runs.
+
+    For each series it keeps the fingerprint of its inputs (files, tool version, labels), its status and the DICOM-SEG
+    files produced. A series is up to date when its fingerprint did not change and it is either `complete` with all
+    its outputs still present, or `skipped` (too few slices, slice mismatch) with the same options.
+    A series left `started` by an interrupted (or failed) run is processed again, after removing its previous outputs:
+    the files of its output folder matching `output_patterns`, as the files written before the interruption are not
+    recorded.
+
+    Leaf folders are also recorded with a fingerprint of their files, so an unchanged folder whose series are all up
+    to date is skipped without reading any DICOM header.
+
+    The manifest is only modified by the main process and is rewritten atomically after every change.
+    """
+
+    def __init__(self, dcm_out, labels=None, min_dcm=None, force=False, options=None, output_patterns=()):
+        """
+        :param dcm_out: output folder (the manifest is saved in it)
+        :param labels: label dictionary, part of the fingerprints
+        :param options: dict of the options changing the outputs (e.g. output mode), part of the fingerprints
+        :param min_dcm: minimum number of slices, recorded for the skipped series
+        :param force: if True, no series is considered up to date (the manifest is still updated)
+        :param output_patterns: glob patterns of the files written in the output folder of a series (e.g.\
+                                '*_WMH_SynthSeg.dcm'), removed when a series left `started` is processed again
+        """
+        self.dcm_out = dcm_out
+        self.output_patterns = tuple(output_patterns)
+        self.path = os.path.join(dcm_out, MANIFEST_NAME)
+        self.min_dcm = min_dcm
+        self.force = force
+        self.version = get_tool_version()
+        self.extra = (self.version, json.dumps(labels, sort_keys=True))
+        if options:
+            self.extra += (json.dumps(options, sort_keys=True),)
+        self.folders = {}
+        self.series = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    content = json.load(f)
+                self.folders = content.get('folders', {})
+                self.series = content.get('series', {})
+            except (OSError, ValueError) as e:
+                logger.warning(f"Unable to read the manifest {self.path}, all the series will be processed: {e}")
+
+    def save(self):
+        os.makedirs(self.dcm_out, exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.version, 'folders': self.folders, 'series': self.series}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def fingerprint(self, files):
+        return fingerprint_files(files, extra=self.extra)
+
+    def is_folder_done(self, folder, files):
+        """
+        Whether a leaf folder did not change since it was recorded and all its series are up to date.
+        """
+        entry = self.folders.get(folder)
+        if self.force or entry is None or entry['fingerprint'] != self.fingerprint(files):
+            return False
+        return all(self._is_entry_done(key) for key in entry['series'])
+
+    def add_folder(self, folder, files, series_keys):
+        """
+        Record a leaf folder and its series (the manifest is saved by the next series update or `save`).
+        """
+        self.folders[folder] = {'fingerprint': self.fingerprint(files), 'series': list(series_keys)}
+
+    def is_series_done(self, key, fingerprint):
+        entry = self.series.get(key)
+        return not self.force and entry is not None and entry['fingerprint'] == fingerprint and self._is_entry_done(key)
+
+    def start_series(self, key, fingerprint, output_folder=None):
+        """
+        Mark a series as started, removing the outputs of a previous partial or outdated run.
+
+        :param output_folder: output folder of the series, recorded so that the files written by an interrupted run\
+                              can be removed when it is started again
+        """
+        entry = self.series.get(key, {})
+        stale = [os.path.join(self.dcm_out, output) for output in entry.get('outputs', [])]
+        if entry.get('status') == 'started':
+            # Interrupted run: its outputs were not recorded
+            folder = entry.get('output_folder')
+            folder = os.path.join(self.dcm_out, folder) if folder is not None else output_folder
+            if folder is not None:
+                for pattern in self.output_patterns:
+                    stale.extend(glob.glob(os.path.join(glob.escape(folder), pattern)))
+        for path in stale:
+            if os.path.isfile(path):
+                logger.info(f"Removing the previous output {path}")
+                os.remove(path)
+        self.series[key] = {'fingerprint': fingerprint, 'status': 'started', 'outputs': []}
+        if output_folder is not None:
+            self.series[key]['output_folder'] = os.path.relpath(output_folder, self.dcm_out)
+        self.save()
+
+    def complete_series(self, key, fingerprint, outputs):
+        outputs = [os.path.relpath(output, self.dcm_out) for output in outputs]
+        self.series[key] = {'fingerprint': fingerprint, 'status': 'complete', 'outputs': outputs}
+        self.save()
+
+    def skip_series(self, key, fingerprint, reason):
+        self.series[key] = {'fingerprint': fingerprint, 'status': 'skipped', 'reason': reason,
+                            'min_dcm': self.min_dcm, 'outputs': []}
+        self.save()
+
+    def _is_entry_done(self, key):
+        entry = self.series.get(key)
+        if entry is None:
+            return False
+        if entry['status'] == 'complete':
+            return all(os.path.isfile(os.path.join(self.dcm_out, output)) for output in entry['outputs'])
+        if entry['status'] == 'skipped':
+            return entry.get('min_dcm') == self.min_dcm
+        return False
@@ -0,0 +1,136 @@
+import collections
+import concurrent.futures
+
+
+class PipelineStage(object):
+    """
+    Stage of a `StagedPipeline`: a function starting the stage on one item, typically on the executor of the stage
+    (process pool, thread pool, inference worker).
+    """
+
+    def __init__(self, name, submit, workers=1, max_queued=2):
+        """
+        :param name: stage name, given to the `on_result` callback
+        :param submit: callable `submit(item)` starting the stage on an item and returning a `concurrent.futures.Future`
+        :param workers: maximum number of items processed at the same time by the stage
+        :param max_queued: maximum number of items waiting for the stage: the previous stage does not start new items\
+                           while this queue is full (at least 1)
+        """
+        if workers < 1 or max_queued < 1:
+            raise ValueError(f"Stage {name}: workers and max_queued must be at least 1, got {workers} and {max_queued}")
+        self.name = name
+        self.submit = submit
+        self.workers = workers
+        self.max_queued = max_queued
+
+
+class StagedPipeline(object):
+    """
+    Producer/consumer pipeline running items through a sequence of stages, each stage with its own executor, so that
+    the stages of different items overlap (e.g. an item is converted while the previous one is in inference and the
+    one before is exported).
+
+    Each stage has a bounded queue of items waiting for it. The items are pulled lazily from the source when the first
+    queue has room, and a stage does not start new items while the queue of the next stage is full. The number of items
+    in flight is then bounded by the sum of the `workers` and `max_queued` of the stages, whatever the speed of each
+    stage, while a slow stage always has items waiting for it.
+
+    The pipeline is driven by the calling thread (the callbacks are called from it):
+    - `on_result(stage_name, item, result)` is called when a stage succeeds on an item, and returns False if the item\
+      must not go to the next stage (e.g. nothing to segment).
+    - `on_finish(item, error)` is called once per item leaving the pipeline, with the exception of the failing stage\
+      (or None).
+
+    The source can be open-ended (e.g. fed by a folder watcher): when it has no item available yet, it yields
+    `StagedPipeline.PENDING` after waiting briefly for one, and the pipeline keeps processing the items in flight,
+    pulling from the source again at least every `poll_interval` seconds.
+
+    Example:
+        pipeline = StagedPipeline([PipelineStage('prepare', prepare, workers=2),
+                                   PipelineStage('inference', infer, workers=1, max_queued=2)],
+                                  on_result=on_result, on_finish=on_finish)
+        pipeline.run(items)
+    """
+
+    # Yielded by a source with no item available yet
+    PENDING = object()
+
+    def __init__(self, stages, on_result, on_finish, poll_interval=1.0):
+        """
+        :param stages: list of PipelineStage, in processing order
+        :param on_result: callback `on_result(stage_name, item, result)` -> bool
+        :param on_finish: callback `on_finish(item, error)`
+        :param poll_interval: maximum time in seconds between two pulls from a source that yielded PENDING
+        """
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages = stages
+        self.on_result = on_result
+        self.on_finish = on_finish
+        self.poll_interval = poll_interval
+
+    def run(self, items):
+        """
+        Run every item of `items` (any iterable, consumed lazily, possibly yielding PENDING) through the stages and
+        wait for all of them.
+        """
+        stages = self.stages
+        last = len(stages) - 1
+        queues = [collections.deque() for _ in stages]
+        busy = [0] * len(stages)
+        running = {}  # future -> (stage index, item)
+        items = iter(items)
+        exhausted = False
+
+        while True:
+            # Pull new items while the first stage has room (backpressure on the source)
+            pending = False
+            while not exhausted and len(queues[0]) < stages[0].max_queued:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                elif item is self.PENDING:
+                    pending = True
+                    break
+                else:
+                    queues[0].append(item)
+
+            # Start the waiting items, unless the queue of the next stage is full
+            for idx in reversed(range(len(stages))):
+                stage = stages[idx]
+                while queues[idx] and busy[idx] < stage.workers and \
+                        (idx == last or len(queues[idx + 1]) < stages[idx + 1].max_queued):
+                    item = queues[idx].popleft()
+                    try:
+                        future = stage.submit(item)
+                    except Exception as e:
+                        self.on_finish(item, e)
+                        continue
+                    running[future] = (idx, item)
+                    busy[idx] += 1
+
+            # The last stage can always start, so nothing running means nothing left, except in the source
+            if not running:
+                if exhausted:
+                    break
+                continue
+
+            done, _ = concurrent.futures.wait(running, timeout=self.poll_interval if pending else None,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                idx, item = running.pop(future)
+                busy[idx] -= 1
+                try:
+                    error = future.exception()
+                except concurrent.futures.CancelledError as e:
+                    error = e
+                go_on = False
+                if error is None:
+                    try:
+                        go_on = self.on_result(stages[idx].name, item, future.result())
+                    except Exception as e:
+                        error = e
+                if error is None and go_on and idx != last:
+                    queues[idx + 1].append(item)
+                else:
+                    self.on_finish(item, error)
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import resource
+import datetime
+import threading
+import contextlib
+
+# Linux only: I/O counters of the current thread (of the process on kernels older than 3.17) and resettable peak RSS
+# of the current process
+PROC_IO_PATHS = ('/proc/thread-self/io', '/proc/self/io')
+PROC_STATUS_PATH = '/proc/self/status'
+PROC_CLEAR_REFS_PATH = '/proc/self/clear_refs'
+
+
+class StageProfiler(object):
+    """
+    Record the wall time, CPU time (process and waited children), bytes read and written and peak RSS of the stages
+    of one series.
+
+    Stages can be nested (e.g. the DICOM-SEG writing of each label inside the export). The I/O counters are those of
+    the thread running the stage (`rchar`/`wchar` of /proc/thread-self/io, i.e. including the reads served by the page
+    cache), so the stages run at the same time by other threads are not counted.
+
+    The peak RSS is a process-wide counter: it is reset at the start of a stage (/proc/self/clear_refs) only if no
+    other stage is open in the process, except the parent stages of the same profiler whose peak so far is kept.
+    Otherwise (or if the kernel does not allow the reset), the recorded peak is the peak of the process since the
+    last reset, which includes the other stages: the `peak_rss_scope` of the record is then 'process' instead of
+    'stage'.
+
+    The records are plain dicts so that a profiler filled in another process can be sent back with its results.
+
+    Example:
+        profiler = StageProfiler()
+        with profiler.stage('reslice'):
+            ...
+        with profiler.stage('dicom_seg', label='CSF'):
+            ...
+        profiler.records
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.records = []
+        self._peaks = []  # peak RSS of the nested stages, one entry per running stage
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        """
+        Context manager recording one stage.
+
+        :param name: stage name
+        :param info: other values saved with the record (e.g. label name)
+        """
+        global _open_stages
+
+        with _open_stages_lock:
+            start = _get_snapshot()
+            if self._peaks:
+                # The peak of the parent stage so far is kept before resetting it
+                self._peaks[-1] = max(self._peaks[-1], start['rss_peak'])
+            # Resetting the peak while a stage of another profiler (or thread) is open would lose its peak
+            scope = 'stage' if _open_stages == len(self._peaks) and _reset_peak_rss() else 'process'
+            self._peaks.append(0)
+            _open_stages += 1
+        try:
+            yield
+        finally:
+            end = _get_snapshot()
+            with _open_stages_lock:
+                _open_stages -= 1
+            peak = max(self._peaks.pop(), end['rss_peak'])
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            record = {'stage': name, **info,
+                      'wall_s': end['wall'] - start['wall'],
+                      'cpu_s': end['cpu'] - start['cpu'],
+                      'read_bytes': _diff(end['read'], start['read']),
+                      'write_bytes': _diff(end['write'], start['write']),
+                      'peak_rss_mb': peak / 1024 ** 2,
+                      'peak_rss_scope': scope}
+            self.records.append(record)
+
+    def add(self, records):
+        """
+        Add the records of a stage profiled in another process.
+        """
+        self.records.extend(records)
+
+    def get_totals(self):
+        """
+        Totals per stage name (nested stages are not subtracted from their parent).
+
+        :return: dict {stage: {'count', 'wall_s', 'cpu_s', 'read_bytes', 'write_bytes', 'peak_rss_mb',\
+                 'peak_rss_scope'}}, the scope is 'process' if the peak of any record is process-wide
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'read_bytes': 0,
+                                                        'write_bytes': 0, 'peak_rss_mb': 0.0,
+                                                        'peak_rss_scope': 'stage'})
+            total['count'] += 1
+            for key in ('wall_s', 'cpu_s', 'read_bytes', 'write_bytes'):
+                total[key] += record[key] or 0
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+            if record.get('peak_rss_scope', 'process') == 'process':
+                total['peak_rss_scope'] = 'process'
+        return totals
+
+
+class NullProfiler(object):
+    """
+    Profiler doing nothing, used when profiling is disabled.
+    """
+
+    enabled = False
+    records = ()
+
+    def stage(self, name, **info):
+        return contextlib.nullcontext()
+
+    def add(self, records):
+        pass
+
+    def get_totals(self):
+        return {}
+
+
+NULL_PROFILER = NullProfiler()
+
+# Number of stages open in the process, all profilers and threads included (see `StageProfiler.stage`)
+_open_stages = 0
+_open_stages_lock = threading.Lock()
+
+
+def call_profiled(enabled, func, *args, **kwargs):
+    """
+    Call `func(*args, profiler=profiler, **kwargs)` with a new profiler and return its result with the records, so
+    that the records of a function run in a process pool get back to the caller.
+
+    :param enabled: if False, `func` gets the NULL_PROFILER and no record is returned
+    :return: (result, records)
+    """
+    profiler = StageProfiler() if enabled else NULL_PROFILER
+    result = func(*args, profiler=profiler, **kwargs)
+    return result, list(profiler.records)
+
+
+class RunProfile(object):
+    """
+    Profile reports of a run: one JSON file per series and a summary of the run, saved in `report_dir`.
+    """
+
+    def __init__(self, report_dir):
+        self.report_dir = report_dir
+        self.start = time.perf_counter()
+        self.profiler = StageProfiler()  # Stages of the run not related to one series (e.g. indexing)
+        self.series = {}
+
+    def save_series(self, series, profiler, status):
+        """
+        Save the report of a series and add it to the run summary.
+
+        :param series: series name (relative output path)
+        :param profiler: StageProfiler of the series
+        :param status: final status of the series (e.g. 'complete', 'skipped', 'failed')
+        """
+        report = {'series': series, 'status': status, 'totals': profiler.get_totals(), 'stages': profiler.records}
+        self.series[series] = report
+        self._write(os.path.join(self.report_dir, f'{series}.json'), report)
+
+    def save_summary(self):
+        """
+        Save the summary of the series profiled so far (totals per stage, slowest series).
+        """
+        totals = {}
+        for report in self.series.values():
+            for stage, total in report['totals'].items():
+                summary = totals.setdefault(stage, {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'read_bytes': 0,
+                                                    'write_bytes': 0, 'peak_rss_mb': 0.0, 'peak_rss_scope': 'stage',
+                                                    'max_wall_s': 0.0})
+                for key in ('count', 'wall_s', 'cpu_s', 'read_bytes', 'write_bytes'):
+                    summary[key] += total[key]
+                summary['peak_rss_mb'] = max(summary['peak_rss_mb'], total['peak_rss_mb'])
+                if total['peak_rss_scope'] == 'process':
+                    summary['peak_rss_scope'] = 'process'
+                summary['max_wall_s'] = max(summary['max_wall_s'], total['wall_s'])
+
+        def series_wall(report):
+            return sum(total['wall_s'] for total in report['totals'].values())
+
+        slowest = sorted(self.series.values(), key=series_wall, reverse=True)[:10]
+        statuses = {}
+        for report in self.series.values():
+            statuses[report['status']] = statuses.get(report['status'], 0) + 1
+        summary = {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'wall_s': time.perf_counter() - self.start,
+            'series_count': len(self.series),
+            'status_count': statuses,
+            'run_stages': self.profiler.records,
+            'stages': totals,
+            'slowest_series': [{'series': report['series'], 'wall_s': series_wall(report)} for report in slowest],
+        }
+        self._write(os.path.join(self.report_dir, 'summary.json'), summary)
+
+    @staticmethod
+    def _write(path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(content, f, indent=2)
+
+
+def _get_snapshot():
+    times = os.times()
+    read, write = _read_proc_io()
+    return {'wall': time.perf_counter(),
+            'cpu': times.user + times.system + times.children_user + times.children_system,
+            'read': read,
+            'write': write,
+            'rss_peak': _read_peak_rss()}
+
+
+def _read_proc_io():
+    for path in PROC_IO_PATHS:
+        try:
+            with open(path, 'r') as f:
+                counters = dict(line.split(':') for line in f)
+            return int(counters['rchar']), int(counters['wchar'])
+        except (OSError, KeyError, ValueError):
+            continue
+    return None, None
+
+
+def _read_peak_rss():
+    """
+    Peak RSS in bytes (VmHWM, or ru_maxrss where /proc is not available)
+    """
+    try:
+        with open(PROC_STATUS_PATH, 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS of the process to its current RSS.
+
+    :return: whether the peak was reset
+    """
+    try:
+        with open(PROC_CLEAR_REFS_PATH, 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _diff(end, start):
+    return None if end is None or start is None else end - start
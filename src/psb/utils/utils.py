@@ -9,6 +9,20 @@ from psb.niiXdcm.dcm2nii import convert_dicom_to_nifti
 
 logger = logging.getLogger(__name__)
 
+
+class SeriesLogger(logging.LoggerAdapter):
+    """
+    Logger adapter prefixing every message with the series being processed, so that the logs of series processed
+    in parallel can be told apart.
+    """
+
+    def __init__(self, logger, series):
+        super().__init__(logger, {'series': series})
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['series']}] {msg}", kwargs
+
+
 def get_last_folders_in_branches(root):
     results = []
 
@@ -27,13 +41,17 @@ def create_directory(directory):
         os.makedirs(directory)
 
 
-def tmp_create(basename):
+def tmp_create(basename, root=None):
     """Create temporary folder and return its path
 
+    :param root: parent folder of the temporary folder (default: system temporary folder)
+
     Copied from https://github.com/spinalcordtoolbox/spinalcordtoolbox/
     """
     prefix = f"{basename}_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
-    tmpdir = tempfile.mkdtemp(prefix=prefix)
+    if root is not None:
+        create_directory(root)
+    tmpdir = tempfile.mkdtemp(prefix=prefix, dir=root)
     logger.info(f"Creating temporary folder ({tmpdir})")
     return tmpdir
 
@@ -45,3 +63,73 @@ def rmtree(folder):
     """
     shutil.rmtree(folder)
 
+
+class WorkspaceQuotaError(RuntimeError):
+    pass
+
+
+class Workspace(object):
+    """
+    Temporary folder holding the intermediate files of one series.
+
+    - It can be created on a RAM-backed folder (e.g. /dev/shm) with `root`.
+    - Intermediates are stored as uncompressed `.nii` by default, so that they are memory-mapped when loaded\
+      instead of being decompressed.
+    - `check_quota` raises a `WorkspaceQuotaError` when the folder exceeds `max_bytes`.
+    - The folder is always removed by `cleanup` (also called when used as a context manager).
+
+    The object only holds paths and numbers, so it can be sent to other processes.
+    """
+
+    def __init__(self, basename, root=None, max_bytes=None):
+        """
+        :param basename: prefix of the temporary folder name
+        :param root: parent folder of the workspace (default: system temporary folder)
+        :param max_bytes: maximum size of the workspace in bytes (None: no limit)
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.path = tmp_create(basename=basename, root=root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cleanup()
+
+    def get_path(self, name, ext='.nii'):
+        """
+        Path of an intermediate file of the workspace.
+        """
+        return os.path.join(self.path, f'{name}{ext}')
+
+    def get_size(self):
+        """
+        Size in bytes of the files in the workspace.
+        """
+        size = 0
+        for folder, _, files in os.walk(self.path):
+            for file in files:
+                try:
+                    size += os.stat(os.path.join(folder, file)).st_size
+                except FileNotFoundError:
+                    pass
+        return size
+
+    def check_quota(self):
+        """
+        Raise a `WorkspaceQuotaError` if the workspace is bigger than its quota.
+        """
+        if self.max_bytes is not None:
+            size = self.get_size()
+            if size > self.max_bytes:
+                raise WorkspaceQuotaError(f"Temporary folder {self.path} uses {size} bytes, "
+                                          f"more than its quota of {self.max_bytes} bytes")
+
+    def cleanup(self):
+        """
+        Remove the workspace and its content (no-op if already removed).
+        """
+        if os.path.isdir(self.path):
+            rmtree(self.path)
+            logger.info(f"Temporary folder {self.path} was deleted")
@@ -0,0 +1,153 @@
+import time
+import queue
+import logging
+import threading
+
+from psb.niiXdcm.series import scan_leaf_folders
+from psb.utils.manifest import fingerprint_files
+
+logger = logging.getLogger(__name__)
+
+
+class InboxWatcher(object):
+    """
+    Poll an inbox folder and report the leaf folders that are complete, i.e. whose file set (names, sizes and
+    modification times) did not change for `settle_time` seconds.
+
+    The inbox is polled by a background thread and the complete folders are put in a bounded queue: when the
+    consumer is behind, the polling waits instead of accumulating folders. A folder is reported again only if its
+    files change after it was reported (e.g. more images of the series arrive late).
+
+    Example:
+        with InboxWatcher('/data/inbox', settle_time=60) as watcher:
+            while True:
+                folders = watcher.get_batch()
+                if folders is None:
+                    break
+                ...
+    """
+
+    def __init__(self, inbox, settle_time=60, poll_interval=10, max_queued=16, extension='.dcm'):
+        """
+        :param inbox: folder receiving the DICOM series
+        :param settle_time: time in seconds without change after which a folder is considered complete
+        :param poll_interval: time in seconds between two scans of the inbox
+        :param max_queued: maximum number of complete folders waiting to be processed
+        :param extension: extension of the DICOM files
+        """
+        self.inbox = inbox
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.extension = extension
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._changes = {}  # folder -> (signature, time of the last change)
+        self._reported = {}  # folder -> signature when reported
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def start(self):
+        """
+        Start polling the inbox in a background thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='InboxWatcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop polling. `get_batch` returns None once the folders already queued are consumed.
+        Safe to call from a signal handler.
+        """
+        self._stop.set()
+
+    def get_batch(self, max_folders=None, timeout=None):
+        """
+        Wait for at least one complete folder and return it with the other folders already queued.
+
+        :param max_folders: maximum number of folders returned (None: all the queued folders)
+        :param timeout: maximum time in seconds to wait for a folder (None: no limit)
+        :return: dict {leaf folder: files} (empty if no folder was complete before the timeout), or None if the\
+                 watcher was stopped and the queue is empty
+        """
+        batch = {}
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not batch:
+            wait = 1 if deadline is None else min(1, max(0, deadline - time.monotonic()))
+            try:
+                folder, files = self._queue.get(timeout=wait)
+                batch[folder] = files
+            except queue.Empty:
+                if self.stopped:
+                    return None
+                if deadline is not None and time.monotonic() >= deadline:
+                    return batch
+        while max_folders is None or len(batch) < max_folders:
+            try:
+                folder, files = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch[folder] = files
+        return batch
+
+    def poll(self, now=None):
+        """
+        Scan the inbox once.
+
+        :return: list of (leaf folder, files) complete since the previous scans and not reported yet
+        """
+        now = time.monotonic() if now is None else now
+        folders = scan_leaf_folders(self.inbox, extension=self.extension)
+        for folder in set(self._changes) - set(folders):
+            del self._changes[folder]
+            self._reported.pop(folder, None)
+
+        complete = []
+        for folder, files in folders.items():
+            if not files:
+                continue
+            signature = _get_signature(files)
+            previous = self._changes.get(folder)
+            if signature is None or previous is None or previous[0] != signature:
+                self._changes[folder] = (signature, now)
+                continue
+            if now - previous[1] >= self.settle_time and self._reported.get(folder) != signature:
+                self._reported[folder] = signature
+                complete.append((folder, files))
+        return complete
+
+    def _run(self):
+        while not self.stopped:
+            try:
+                complete = self.poll()
+            except Exception as e:
+                logger.error(f"Unable to scan the inbox {self.inbox}: {e}")
+                complete = []
+            for item in complete:
+                logger.info(f"Series folder complete: {item[0]} ({len(item[1])} files)")
+                while not self.stopped:
+                    try:
+                        self._queue.put(item, timeout=self.poll_interval)
+                        break
+                    except queue.Full:
+                        continue
+            self._stop.wait(self.poll_interval)
+
+
+def _get_signature(files):
+    try:
+        return fingerprint_files(files)
+    except OSError:
+        # A file was removed or renamed during the scan, the folder is still changing
+        return None